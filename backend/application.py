@@ -1,15 +1,31 @@
-from flask import Flask, redirect, jsonify, session, request
+from flask import Flask, Response, redirect, jsonify, session, request, g, stream_with_context
 import requests
+from requests.adapters import HTTPAdapter
 import urllib.parse
 import datetime
 from flask_cors import CORS  # Import CORS
 from concurrent.futures import ThreadPoolExecutor
-import pandas as pd
-from collections import Counter
+from collections import Counter, OrderedDict, deque
+from itertools import islice
 import math
 import random
+import re
+import asyncio
+import contextvars
+import threading
+import time
+import json
 from dotenv import load_dotenv
 import os
+import secrets
+from werkzeug.local import LocalProxy
+from cache import make_cache
+from compression import choose_encoding, compressible, compress, StreamCompressor
+from ranking import Constraints, rank
+from singleflight import Singleflight
+from telemetry import (
+    begin_request, end_request, trace_requested, traced, OutboundCall, endpoint_label, render_metrics, render_gauges, log_event, log_error,
+)
 
 load_dotenv()
 
@@ -25,6 +41,8 @@ backend_origin = "http://18.218.68.142:5001"  # Your EC2 production IP
 CORS(application, resources={r"/*": {"origins": [frontend_test, frontend_origin, backend_origin]}}, supports_credentials=True)
 
 application.config['SECRET_KEY'] = os.getenv('SECRET_KEY')  # Ensure this key is set and remains consistent
+if not application.config['SECRET_KEY']: # signs the session ID every per-user request is looked up by
+    raise RuntimeError("SECRET_KEY must be set")
 application.config['SESSION_COOKIE_SECURE'] = True  # Set to False for local development if using HTTP
 application.config['SESSION_COOKIE_SAMESITE'] = 'Lax'  # Or 'None' if using secure cross-site cookies
 application.config['SESSION_PERMANENT'] = False  # Consider disabling permanent sessions if you only need temporary data
@@ -34,8 +52,8 @@ CLIENT_ID = os.getenv('CLIENT_ID')
 CLIENT_SECRET = os.getenv('CLIENT_SECRET')
 REDIRECT_URI = os.getenv('REDIRECT_URI')
 AUTH_URL = 'https://accounts.spotify.com/authorize'
-TOKEN_URL = 'https://accounts.spotify.com/api/token'
-API_BASE_URL = 'https://api.spotify.com/v1/'
+TOKEN_URL = os.getenv('TOKEN_URL', 'https://accounts.spotify.com/api/token') # overridable to point at bench/fake_spotify.py
+API_BASE_URL = os.getenv('API_BASE_URL', 'https://api.spotify.com/v1/')
 
 keywords = {
     'workout': [
@@ -72,15 +90,605 @@ keywords = {
 target_features = {
     'workout': "min_energy={energy}&min_tempo={tempo}&min_danceability={danceability}&min_valence={valence}",
     'relaxation': "min_acousticness={acousticness}&min_valence={valence}&max_energy={energy}&max_tempo={tempo}",
-    'roadtrip': "target_energy={energy}&target_danceability={danceability}&target_tempo={tempo}",
+    'road_trip': "target_energy={energy}&target_danceability={danceability}&target_tempo={tempo}",
     'party': "min_energy={energy}&min_danceability={danceability}&min_valence={valence}",
     'focus': "min_acousticness={acousticness}&max_energy={energy}",
     'cooking': "target_energy={energy}&target_tempo={tempo}&target_valence={valence}",
     'cleaning': "min_energy={energy}&min_tempo={tempo}&min_danceability={danceability}",
-    'datenight': "min_acousticness={acousticness}&min_valence={valence}&max_tempo={tempo}&max_energy={energy}"
+    'date_night': "min_acousticness={acousticness}&min_valence={valence}&max_tempo={tempo}&max_energy={energy}"
 }
 
-credentials = {} # use credentials global object in place of session for demo version
+ACTIVITY_ALIASES = {'roadtrip': 'road_trip', 'datenight': 'date_night'} # older spellings of the activity keys
+
+
+class ActivityMatcher:
+    '''Tags a playlist name with every activity whose keywords it contains, in one regex pass.
+
+    The pattern is a zero-width lookahead over all keywords, longest first, so it reports the
+    longest keyword starting at each position. Each keyword maps to the activities of every
+    keyword it contains, which keeps the original substring semantics for overlapping keywords.
+    '''
+
+    def __init__(self, keywords):
+        own_activities = {}
+        for activity, activity_keywords in keywords.items():
+            for keyword in activity_keywords:
+                own_activities.setdefault(keyword, set()).add(activity)
+        self.activities_by_keyword = {
+            keyword: frozenset().union(*(activities for other, activities in own_activities.items() if other in keyword))
+            for keyword in own_activities
+        }
+        alternation = '|'.join(re.escape(keyword) for keyword in sorted(own_activities, key=len, reverse=True))
+        self.pattern = re.compile(f'(?=({alternation}))')
+
+    def activities(self, name):
+        matches = self.pattern.finditer(name.lower())
+        return frozenset().union(*(self.activities_by_keyword[match.group(1)] for match in matches))
+
+
+activity_matcher = ActivityMatcher(keywords)
+
+def normalize_activity(activity):
+    activity = ACTIVITY_ALIASES.get(activity, activity)
+    if activity not in keywords:
+        raise ValueError(f"Unknown activity: {activity}")
+    return activity
+
+AUDIO_FEATURES = ('acousticness', 'energy', 'valence', 'danceability', 'tempo') # features averaged into the user profile
+
+# USER SESSIONS
+
+
+# Per-user state (access token, profile-derived seeds) lives in a shared store keyed by a random
+# session ID. Only that ID travels, signed, so any worker can serve any user. It's carried by the
+# Flask session cookie and, for the deployed frontend whose API hosts are cross-site (where a Lax
+# cookie is never sent), by an X-Session header holding the same signed value. The login callback
+# hands that value to the frontend in its redirect's URL fragment.
+SESSION_HEADER = 'X-Session'
+
+user_sessions = make_cache(
+    'user_sessions',
+    max_entries=int(os.getenv('SESSION_STORE_SIZE', 10000)),
+    ttl=int(os.getenv('SESSION_TTL', 24 * 3600)),
+    backend=os.getenv('SESSION_BACKEND'),
+)
+
+def signed_session_id(sid):
+    return application.session_interface.get_signing_serializer(application).dumps({'sid': sid})
+
+def unsign_session_id(value): # the session ID in a signed cookie or X-Session value, None if invalid
+    if not value:
+        return None
+    serializer = application.session_interface.get_signing_serializer(application)
+    try:
+        return serializer.loads(value, max_age=int(application.permanent_session_lifetime.total_seconds())).get('sid')
+    except Exception:
+        return None
+
+def current_user(): # loaded from the store once per request context
+    if 'user' not in g:
+        g.sid = unsign_session_id(request.headers.get(SESSION_HEADER)) or session.get('sid')
+        g.user = user_sessions.get(g.sid, {}) if g.sid else {}
+    return g.user
+
+session_locks = [threading.Lock() for _ in range(64)] # striped by session ID, bounded however many sessions there are
+
+def session_lock(sid):
+    return session_locks[hash(sid) % len(session_locks)]
+
+def update_session(sid, changes): # merged into the stored state, so concurrent requests don't undo each other's changes
+    with session_lock(sid):
+        stored = user_sessions.get(sid, {})
+        stored.update(changes)
+        user_sessions.set(sid, stored)
+
+def save_credentials(**changes): # persist changes to the current user's state, starting a new session if needed
+    current_user().update(changes)
+    if not g.sid: # only the login callback gets here, worker threads always have a sid
+        g.sid = session['sid'] = secrets.token_urlsafe(32)
+    update_session(g.sid, changes)
+
+def clear_credentials():
+    current_user()
+    session.pop('sid', None)
+    if g.sid:
+        user_sessions.delete(g.sid)
+    g.sid = None
+    g.user = {}
+
+credentials = LocalProxy(current_user) # the requesting user's state, reads like the old global dict
+
+# SPOTIFY HTTP CLIENT
+
+
+class RateLimiter:
+    '''Token buckets for outbound Spotify calls, one shared by the whole app plus one per access token.
+
+    reserve() never blocks, it books the caller's slot and returns how long to wait for it, so the
+    same limiter paces both the threaded and the asyncio clients. A 429 blocks every bucket until
+    its Retry-After has passed. A rate of 0 turns that bucket's pacing off, leaving 429s alone to
+    throttle the app. A caller that would have to wait longer than its max_wait fails instead.
+    '''
+
+    def __init__(self, rate, token_rate, max_tokens=10000):
+        self.rate = rate
+        self.token_rate = token_rate
+        self.max_tokens = max_tokens
+        self._app_bucket = [rate * 2, time.monotonic()] # [available, updated_at], bursts up to 2s worth
+        self._token_buckets = OrderedDict()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+        self.waiting = 0
+        self.max_waiting = 0
+        self.waits = 0
+        self.total_wait = 0.0
+        self.throttled = 0
+
+    def _take(self, bucket, rate, now):
+        bucket[0] = min(rate * 2, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        bucket[0] -= 1
+        return -bucket[0] / rate if bucket[0] < 0 else 0.0
+
+    def reserve(self, token):
+        with self._lock:
+            now = time.monotonic()
+            delay = self._blocked_until - now
+            if self.rate > 0:
+                delay = max(delay, self._take(self._app_bucket, self.rate, now))
+            if token and self.token_rate > 0:
+                bucket = self._token_buckets.pop(token, None) or [self.token_rate * 2, now]
+                self._token_buckets[token] = bucket
+                if len(self._token_buckets) > self.max_tokens:
+                    self._token_buckets.popitem(last=False)
+                delay = max(delay, self._take(bucket, self.token_rate, now))
+            return delay
+
+    def penalize(self, retry_after): # Spotify's limit is per app, so a 429 holds back every caller
+        with self._lock:
+            self._blocked_until = max(self._blocked_until, time.monotonic() + retry_after)
+            self.throttled += 1
+
+    def _enter(self, delay):
+        with self._lock:
+            self.waiting += 1
+            self.max_waiting = max(self.max_waiting, self.waiting)
+            self.waits += 1
+            self.total_wait += delay
+
+    def _leave(self):
+        with self._lock:
+            self.waiting -= 1
+
+    def _check(self, delay, max_wait):
+        if max_wait is not None and delay > max_wait:
+            raise ValueError(f"Spotify is rate limiting requests, retry in {math.ceil(delay)}s")
+
+    def wait(self, token, max_wait=None):
+        delay = self.reserve(token)
+        self._check(delay, max_wait)
+        if delay > 0:
+            self._enter(delay)
+            try:
+                time.sleep(delay)
+            finally:
+                self._leave()
+
+    async def wait_async(self, token, max_wait=None):
+        delay = self.reserve(token)
+        self._check(delay, max_wait)
+        if delay > 0:
+            self._enter(delay)
+            try:
+                await asyncio.sleep(delay)
+            finally:
+                self._leave()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'queue_depth': self.waiting,
+                'max_queue_depth': self.max_waiting,
+                'waits': self.waits,
+                'avg_wait_ms': round(self.total_wait / self.waits * 1000, 2) if self.waits else 0.0,
+                'total_wait_s': round(self.total_wait, 3),
+                'throttled': self.throttled,
+            }
+
+
+class CallStats:
+    '''Call count, error count and latency for an outbound HTTP client.'''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = 0
+        self._errors = 0
+        self._total_latency = 0.0
+        self._max_latency = 0.0
+
+    def _record(self, elapsed, error=False):
+        with self._lock:
+            self._calls += 1
+            self._total_latency += elapsed
+            self._max_latency = max(self._max_latency, elapsed)
+            if error:
+                self._errors += 1
+
+    def stats(self):
+        with self._lock:
+            calls, errors = self._calls, self._errors
+            total_latency, max_latency = self._total_latency, self._max_latency
+        return {
+            'calls': calls,
+            'errors': errors,
+            'avg_latency_ms': round(total_latency / calls * 1000, 2) if calls else 0.0,
+            'max_latency_ms': round(max_latency * 1000, 2),
+        }
+
+
+class SpotifyClient(CallStats):
+    '''Shared keep-alive client for every outbound Spotify call.
+
+    Wraps a single requests.Session so TCP/TLS connections to api.spotify.com
+    are pooled and reused across requests instead of being re-opened per call.
+    '''
+
+    def __init__(self, limiter, base_url=API_BASE_URL, pool_size=10, connect_timeout=3.05, read_timeout=10, max_retries=3, max_retry_after=30):
+        super().__init__()
+        self.limiter = limiter
+        self.base_url = base_url
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_retries = max_retries # 429 retries per call
+        self.max_retry_after = max_retry_after # longer Retry-After values and limiter waits are returned to the caller instead
+        self.session = requests.Session()
+        self.adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+
+    def request(self, method, endpoint, headers=None, **kwargs):
+        '''Sends one Spotify call, paced by the rate limiter.
+
+        Without explicit headers the request's own credentials are used, and a 401 refreshes
+        them once before retrying. A 429 is retried after its Retry-After, up to max_retries.
+        '''
+        url = endpoint if endpoint.startswith('http') else self.base_url + endpoint
+        kwargs.setdefault('timeout', self.timeout)
+        use_request_auth = headers is None
+        refreshed = False
+        with OutboundCall(method, endpoint_label(url, self.base_url)) as call:
+            for attempt in range(self.max_retries + 1):
+                if use_request_auth:
+                    headers = auth_headers()
+                token = headers.get('Authorization')
+                if token: # token endpoint calls aren't counted against the API rate limit
+                    self.limiter.wait(token, self.max_retry_after)
+                call.attempts += 1
+                start = time.perf_counter()
+                try:
+                    response = self.session.request(method, url, headers=headers, **kwargs)
+                except requests.RequestException:
+                    self._record(time.perf_counter() - start, error=True)
+                    raise
+                self._record(time.perf_counter() - start, error=not response.ok)
+                call.status, call.bytes = response.status_code, len(response.content)
+                if response.status_code == 401 and use_request_auth and not refreshed:
+                    refresh_auth(token)
+                    refreshed = True
+                    continue
+                if response.status_code == 429 and attempt < self.max_retries:
+                    retry_after = retry_after_seconds(response.headers)
+                    if retry_after <= self.max_retry_after: # only a wait we'll sit out holds back the other callers
+                        self.limiter.penalize(retry_after)
+                        continue
+                return response
+            return response
+
+    def get(self, endpoint, **kwargs):
+        return self.request('GET', endpoint, **kwargs)
+
+    def post(self, endpoint, **kwargs):
+        return self.request('POST', endpoint, **kwargs)
+
+    def _connections_opened(self):
+        # urllib3 counts every new socket per host pool, reused sockets don't increment it
+        pools = self.adapter.poolmanager.pools
+        with pools.lock:
+            return sum(pool.num_connections for pool in pools._container.values())
+
+    def stats(self):
+        stats = super().stats()
+        opened = self._connections_opened()
+        stats['connections_opened'] = opened
+        stats['connection_reuse_rate'] = round(1 - opened / stats['calls'], 4) if stats['calls'] else 0.0
+        return stats
+
+
+def retry_after_seconds(headers):
+    try:
+        return max(float(headers.get('Retry-After', 1)), 0.0)
+    except ValueError: # HTTP-date form, Spotify only sends seconds
+        return 1.0
+
+def auth_headers(): # built once per request context and reused by every helper call
+    if 'spotify_headers' not in g:
+        if token_expired(credentials):
+            refresh_user_token(bearer(credentials))
+        g.spotify_headers = {'Authorization': bearer(credentials)}
+    return g.spotify_headers
+
+TOKEN_KEYS = ('access_token', 'refresh_token', 'expires_at') # the parts of a session a refresh rewrites
+
+def bearer(user):
+    return f"Bearer {user.get('access_token')}"
+
+def refresh_auth(rejected_token): # Spotify rejected the request's token, get a new one for the rest of the request
+    if g.get('app_auth'):
+        app_token.clear()
+        g.spotify_headers = app_auth_headers()
+    else:
+        refresh_user_token(rejected_token)
+        g.pop('spotify_headers', None)
+
+def token_expired(user):
+    return 'expires_at' in user and user['expires_at'] - 60 < time.time()
+
+def refresh_access_token(user): # swaps the user's refresh token for a new access token, in place
+    if 'refresh_token' not in user:
+        raise ValueError("Session expired, please log in again")
+    req_body = {
+        'grant_type': 'refresh_token',
+        'refresh_token': user['refresh_token'],
+        'client_id': CLIENT_ID,
+        'client_secret': CLIENT_SECRET,
+    }
+    response = spotify.post(TOKEN_URL, headers={}, data=req_body) # generate new token
+    if not response.ok:
+        raise ValueError("Unable to refresh authentication token")
+    new_token_info = response.json()
+    user['access_token'] = new_token_info['access_token']
+    user['expires_at'] = time.time() + new_token_info['expires_in']
+    if 'refresh_token' in new_token_info: # Spotify may rotate it
+        user['refresh_token'] = new_token_info['refresh_token']
+    return user
+
+def refresh_user_token(stale_token):
+    user = current_user()
+    refresh_session_token(g.sid, user, stale_token)
+
+def refresh_session_token(sid, user, stale_token):
+    '''Refreshes a session's access token in place and stores it, once for concurrent callers.
+
+    Every worker thread of a request, and every request of the session, may see the same token
+    rejected or expired. The first caller refreshes it, later callers whose stale_token has been
+    replaced in the meantime pick up the stored token instead of spending the refresh token again,
+    which fails with invalid_grant once Spotify has rotated it.
+    '''
+    with session_lock(sid):
+        stored = (user_sessions.get(sid) if sid else None) or {}
+        for key in TOKEN_KEYS:
+            if key in stored:
+                user[key] = stored[key]
+        if bearer(user) != stale_token:
+            return user
+        refresh_access_token(user)
+        if sid: # only the token is written back, the rest of the stored state may be newer than the caller's
+            stored.update({key: user[key] for key in TOKEN_KEYS if key in user})
+            user_sessions.set(sid, stored)
+        return user
+
+app_token = {} # client-credentials token, only used for user-independent calls made in the background
+app_token_lock = threading.Lock()
+
+def app_auth_headers():
+    with app_token_lock:
+        if app_token.get('expires_at', 0) - 60 < time.time():
+            req_body = {
+                'grant_type': 'client_credentials',
+                'client_id': CLIENT_ID,
+                'client_secret': CLIENT_SECRET
+            }
+            response = spotify.post(TOKEN_URL, headers={}, data=req_body)
+            if not response.ok:
+                raise ValueError("Failed to fetch app token")
+            token_info = response.json()
+            app_token['access_token'] = token_info['access_token']
+            app_token['expires_at'] = time.time() + token_info['expires_in']
+        return {'Authorization': f"Bearer {app_token['access_token']}"}
+
+SPOTIFY_POOL_SIZE = int(os.getenv('SPOTIFY_POOL_SIZE', 10))
+SPOTIFY_CONNECT_TIMEOUT = float(os.getenv('SPOTIFY_CONNECT_TIMEOUT', 3.05))
+SPOTIFY_READ_TIMEOUT = float(os.getenv('SPOTIFY_READ_TIMEOUT', 10))
+
+# Spotify's limit is a rolling 30 second window whose size isn't published, so calls aren't paced by
+# default: a 429 blocks every caller for its Retry-After instead. Set these to cap requests/second.
+SPOTIFY_RATE_LIMIT = float(os.getenv('SPOTIFY_RATE_LIMIT', 0)) # across every user of the app, 0 = no pacing
+SPOTIFY_TOKEN_RATE_LIMIT = float(os.getenv('SPOTIFY_TOKEN_RATE_LIMIT', 0)) # per access token, 0 = no pacing
+SPOTIFY_MAX_RETRIES = int(os.getenv('SPOTIFY_MAX_RETRIES', 3))
+SPOTIFY_MAX_RETRY_AFTER = float(os.getenv('SPOTIFY_MAX_RETRY_AFTER', 30))
+
+spotify_limiter = RateLimiter(SPOTIFY_RATE_LIMIT, SPOTIFY_TOKEN_RATE_LIMIT)
+spotify = SpotifyClient(
+    spotify_limiter,
+    pool_size=SPOTIFY_POOL_SIZE,
+    connect_timeout=SPOTIFY_CONNECT_TIMEOUT,
+    read_timeout=SPOTIFY_READ_TIMEOUT,
+    max_retries=SPOTIFY_MAX_RETRIES,
+    max_retry_after=SPOTIFY_MAX_RETRY_AFTER,
+)
+http_clients = {'spotify': spotify} # reported on /metrics, the ASGI mode registers its async client here
+spotify_flights = Singleflight('spotify') # identical GETs in flight at once share one Spotify call, see fetch_json
+singleflights = {'spotify': spotify_flights} # reported on /metrics, the ASGI mode registers its own here
+
+PROFILE_MAX_WORKERS = int(os.getenv('PROFILE_MAX_WORKERS', 4)) # per-request cap on concurrent Spotify calls
+PROFILE_CALL_DEADLINE = float(os.getenv('PROFILE_CALL_DEADLINE', 10)) # seconds to wait on any single call
+ARTIST_BATCH_SIZE = 50 # max IDs accepted by the /artists endpoint
+ARTIST_MAX_WORKERS = int(os.getenv('ARTIST_MAX_WORKERS', 4))
+
+# artist genres barely change, playlist listings are keyed by snapshot_id so a short TTL only bounds staleness of searches
+artist_genre_cache = make_cache('artist_genres', max_entries=int(os.getenv('ARTIST_CACHE_SIZE', 50000)), ttl=7 * 24 * 3600)
+# [track_id, first artist_id] per track, shared by seed analysis and the ranking candidate pool
+playlist_tracks_cache = make_cache('playlist_track_pairs', max_entries=int(os.getenv('PLAYLIST_CACHE_SIZE', 2000)), ttl=3600)
+# AUDIO_FEATURES vector per track, [] for tracks Spotify has no analysis for
+audio_feature_cache = make_cache('audio_features', max_entries=int(os.getenv('AUDIO_FEATURE_CACHE_SIZE', 200000)), ttl=30 * 24 * 3600)
+# per-user playlist -> activities index, kept past its refresh time so a re-list only reclassifies changed playlists
+playlist_index_cache = make_cache('playlist_index', max_entries=int(os.getenv('PLAYLIST_INDEX_CACHE_SIZE', 10000)), ttl=24 * 3600)
+
+# SEED CANDIDATE POOL
+
+
+class SeedCandidatePool:
+    '''Per-activity pool of popular-playlist seed candidates.
+
+    Each candidate is a {'playlist_id', 'artist', 'genre'} dict computed from the same
+    /search query random_popular_playlist uses. Pools are refreshed on a background
+    thread with the app token once they go stale, so requests only sample from memory.
+    '''
+
+    def __init__(self, size=10, refresh_interval=6 * 3600):
+        self.size = size
+        self.refresh_interval = refresh_interval
+        self._candidates = {}
+        self._refreshed_at = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+
+    def refresh(self, activity):
+        playlists = search_popular_playlists(activity)
+        random.shuffle(playlists)
+        candidates = []
+        for playlist_id, snapshot_id in playlists[:self.size]:
+            try:
+                top_artist_and_genre = get_top_artist_and_genre(playlist_id, snapshot_id)
+            except Exception as e:
+                log_error(f"Skipping seed candidate {playlist_id}. {str(e)}")
+                continue
+            candidates.append({'playlist_id': playlist_id, **top_artist_and_genre})
+        with self._lock:
+            if candidates:
+                self._candidates[activity] = candidates
+            self._refreshed_at[activity] = time.time()
+        return candidates
+
+    def ensure_fresh(self, activity): # starts a background refresh if the pool is missing or stale
+        with self._lock:
+            stale = time.time() - self._refreshed_at.get(activity, 0) > self.refresh_interval
+            if not stale or activity in self._refreshing:
+                return
+            self._refreshing.add(activity)
+        threading.Thread(target=self._refresh_in_background, args=(activity,), daemon=True).start()
+
+    def _refresh_in_background(self, activity):
+        try:
+            run_with_app_token(self.refresh, activity)
+        except Exception as e:
+            log_error(f"Seed pool refresh for {activity} failed. {str(e)}")
+        finally:
+            with self._lock:
+                self._refreshing.discard(activity)
+
+    def add(self, activity, candidate): # live draws made while the pool is cold are kept for later requests
+        with self._lock:
+            candidates = self._candidates.setdefault(activity, [])
+            if len(candidates) < self.size:
+                candidates.append(candidate)
+
+    def sample(self, activity, exclude_artists, exclude_genres):
+        with self._lock:
+            candidates = [
+                candidate for candidate in self._candidates.get(activity, [])
+                if candidate['artist'] not in exclude_artists and candidate['genre'] not in exclude_genres
+            ]
+        return random.choice(candidates) if candidates else None
+
+    def stats(self):
+        with self._lock:
+            return {activity: len(candidates) for activity, candidates in self._candidates.items()}
+
+
+seed_pool = SeedCandidatePool(
+    size=int(os.getenv('SEED_POOL_SIZE', 10)),
+    refresh_interval=int(os.getenv('SEED_POOL_REFRESH', 6 * 3600)),
+)
+SEED_MAX_ATTEMPTS = 3 # live popular-playlist draws allowed per request when the pool can't supply a seed
+
+# TASTE SNAPSHOTS
+
+
+class TasteSnapshots:
+    '''Versioned per-user taste snapshots, keyed by Spotify user ID.
+
+    A snapshot is {'version', 'features', 'top_artists', 'top_genres', 'computed_at'}, features
+    being None when Spotify has no audio features to give (see fetch_average_audio_features). It lives in
+    its own store (SQLite by default) so it outlives sessions, restarts and workers. Snapshots older
+    than max_age are still served while one background refresh per user recomputes them, snapshots
+    written by an older version are treated as missing.
+    '''
+
+    version = 1
+
+    def __init__(self, store, max_age=24 * 3600):
+        self.store = store
+        self.max_age = max_age
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self.refreshes = 0
+
+    def snapshot(self, features, top_artists, top_genres):
+        return {
+            'version': self.version,
+            'features': features,
+            'top_artists': top_artists,
+            'top_genres': top_genres,
+            'computed_at': time.time(),
+        }
+
+    def get(self, user_id):
+        snapshot = self.store.get(user_id)
+        if not snapshot or snapshot.get('version') != self.version:
+            return None
+        return snapshot
+
+    def put(self, user_id, snapshot):
+        self.store.set(user_id, snapshot)
+
+    def is_stale(self, snapshot):
+        return time.time() - snapshot['computed_at'] > self.max_age
+
+    def begin_refresh(self, user_id): # False when a refresh for the user is already running
+        with self._lock:
+            if user_id in self._refreshing:
+                return False
+            self._refreshing.add(user_id)
+            self.refreshes += 1
+            return True
+
+    def end_refresh(self, user_id):
+        with self._lock:
+            self._refreshing.discard(user_id)
+
+    def stats(self):
+        with self._lock:
+            return {'refreshes': self.refreshes, 'refreshing': len(self._refreshing), 'max_age': self.max_age}
+
+
+taste_snapshots = TasteSnapshots(
+    make_cache('taste_snapshots', max_entries=int(os.getenv('TASTE_CACHE_SIZE', 100000)), ttl=90 * 24 * 3600, backend=os.getenv('TASTE_BACKEND', 'sqlite')),
+    max_age=int(os.getenv('TASTE_MAX_AGE', 24 * 3600)),
+)
+
+PAGINATION_MAX_WORKERS = int(os.getenv('PAGINATION_MAX_WORKERS', 4)) # pages fetched ahead of the consumer
+PLAYLIST_INDEX_REFRESH = int(os.getenv('PLAYLIST_INDEX_REFRESH', 300)) # seconds before a user's playlist index is re-listed
+PLAYLIST_TRACKS_LIMIT = int(os.getenv('PLAYLIST_TRACKS_LIMIT', 1000)) # tracks analyzed per playlist
+PLAYLIST_TRACK_FIELDS = 'items(track(id,artists(id))),total' # only what seed analysis and ranking read
+
+PLAYLIST_CHUNK_SIZE = 100 # max URIs per add-items call
+BUILD_CHUNK_RETRIES = int(os.getenv('BUILD_CHUNK_RETRIES', 2)) # extra attempts for a chunk that fails with a 5xx or network error
+
+RANK_MAX_PLAYLISTS = int(os.getenv('RANK_MAX_PLAYLISTS', 3)) # matched playlists sampled into the candidate pool
+RANK_POOL_SIZE = int(os.getenv('RANK_POOL_SIZE', 2000)) # candidates scored per request
+RANK_PER_ARTIST = int(os.getenv('RANK_PER_ARTIST', 3)) # tracks allowed per artist in the ranked result
+AUDIO_FEATURES_BATCH_SIZE = 100 # max IDs accepted by the /audio-features endpoint
+TRACKS_BATCH_SIZE = 50 # max IDs accepted by the /tracks endpoint
 
 # API ENDPOINTS
 
@@ -89,6 +697,56 @@ credentials = {} # use credentials global object in place of session for demo ve
 def ping():
     return jsonify('pong!')
 
+@application.route('/stats')
+def stats():
+    return jsonify(service_stats())
+
+@application.route('/metrics') # Prometheus text format
+def metrics():
+    stats = service_stats()
+    lines = render_gauges('elevate_http_client', 'Outbound HTTP client', {(('client', name),): stats[name] for name in http_clients})
+    lines += render_gauges('elevate_rate_limiter', 'Spotify rate limiter', {(): stats['rate_limiter']})
+    lines += render_gauges('elevate_cache', 'Cache', {(('cache', name),): cache for name, cache in stats['cache'].items()})
+    lines += render_gauges('elevate_seed_pool', 'Seed candidate pool', {(('activity', activity),): {'candidates': size} for activity, size in stats['seed_pool'].items()})
+    lines += render_gauges('elevate_taste_snapshots', 'Taste snapshots', {(): stats['taste_snapshots']})
+    lines += render_gauges('elevate_singleflight', 'Coalesced Spotify requests', {(('flight', name),): flight for name, flight in stats['singleflight'].items()})
+    return Response(render_metrics(lines), mimetype='text/plain; version=0.0.4')
+
+@application.before_request
+def start_request_scope(): # request ID, route latency and (when sampled) the span tree
+    g.request_scope = begin_request(
+        request.url_rule.rule if request.url_rule else 'unmatched',
+        request.method,
+        request.headers.get('X-Request-ID', '')[:64] or None,
+        trace_requested(request.headers.get('X-Trace')),
+    )
+
+@application.after_request
+def finish_request_scope(response):
+    scope = g.pop('request_scope', None)
+    if scope is not None:
+        response.headers['X-Request-ID'] = scope.request_id
+        end_request(scope, response.status_code)
+    return response
+
+@application.after_request
+def compress_response(response): # gzip/brotli for buffered bodies, streamed ones compress themselves
+    if (response.is_streamed or response.direct_passthrough or 'Content-Encoding' in response.headers
+            or not compressible(response.mimetype, response.content_length or 0)):
+        return response
+    response.vary.add('Accept-Encoding')
+    encoding = choose_encoding(request.headers.get('Accept-Encoding'))
+    if encoding:
+        response.set_data(compress(response.get_data(), encoding))
+        response.headers['Content-Encoding'] = encoding
+    return response
+
+@application.teardown_request
+def abandon_request_scope(error=None): # unhandled exceptions skip after_request
+    scope = g.pop('request_scope', None)
+    if scope is not None:
+        end_request(scope, 500, str(error) if error else None)
+
 @application.route('/login')
 def login():
     try:
@@ -103,7 +761,7 @@ def login():
         auth_url = f"{AUTH_URL}?{urllib.parse.urlencode(params)}"
         return redirect(auth_url) # redirects to spotify login page
     except Exception as e:
-        print(f"Error: {str(e)}")
+        log_error(str(e))
         return jsonify({"message": f'Login failed. {str(e)}'}), 500
 
 # redirect user after successful spotify login
@@ -122,18 +780,20 @@ def callback():
             'client_id': CLIENT_ID,
             'client_secret': CLIENT_SECRET
         }
-        response = requests.post(TOKEN_URL, data=req_body)
+        response = spotify.post(TOKEN_URL, headers={}, data=req_body)
         if response.status_code != 200:
             raise ValueError(f"Failed to fetch token")
         token_info = response.json()
-        #session['access_token'] = token_info['access_token']
-        #session['refresh_token'] = token_info['refresh_token']
-        #session['expires_at'] = datetime.datetime.now().timestamp() + token_info['expires_in']
-        global credentials  # Declare 'test' as global to modify it
-        credentials['access_token'] = token_info['access_token']
-        return redirect('https://main.d30okcwstuwyij.amplifyapp.com/profile') # redirects to react app
+        clear_credentials() # a fresh login always starts a fresh session
+        save_credentials(
+            access_token=token_info['access_token'],
+            refresh_token=token_info['refresh_token'],
+            expires_at=time.time() + token_info['expires_in'],
+        )
+        # redirects to react app, the fragment never reaches a server and the app sends it back as X-Session
+        return redirect(f"https://main.d30okcwstuwyij.amplifyapp.com/profile#session={signed_session_id(g.sid)}")
     except Exception as e:
-        print(f"Error: {str(e)}")
+        log_error(str(e))
         return jsonify({"message": f'Login failed. {str(e)}'}), 500
     
 # pull user data upon successful login to build user 'profile'
@@ -146,72 +806,49 @@ def profile():
     try:
         # Check if the user is authenticated
         if 'access_token' not in credentials:
-            print("Access token missing in credentials")
+            log_event('access_token_missing')
             return redirect('/login')
         
-        headers = {'Authorization': f"Bearer {credentials.get('access_token')}"}
         endpoints = {
             'profile': 'me',  # Endpoint to get profile info
             'top_artists': 'me/top/artists',  # Get top artists
             'top_tracks': 'me/top/tracks'     # Get top tracks
         }
 
-        # Call each endpoint sequentially
-        profile_info = {}
-        for key, endpoint in endpoints.items():
-            response = requests.get(API_BASE_URL + endpoint, headers=headers)
-            profile_info[key] = response.json()
+        # Call each endpoint concurrently, audio features start as soon as top tracks arrive
+        executor = ThreadPoolExecutor(max_workers=PROFILE_MAX_WORKERS)
+        try:
+            futures = {key: submit_in_context(executor, fetch_json, endpoint) for key, endpoint in endpoints.items()}
+            top_tracks = futures['top_tracks'].result(timeout=PROFILE_CALL_DEADLINE)
+            track_ids = [track['id'] for track in top_tracks['items']]
+            features_future = submit_in_context(executor, fetch_average_audio_features, track_ids)
+            profile_info = {key: future.result(timeout=PROFILE_CALL_DEADLINE) for key, future in futures.items()}
+            avg_audio_features = features_future.result(timeout=PROFILE_CALL_DEADLINE)
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True) # don't hold the request on a call past its deadline
 
-        # Process retrieved data
-        artist_ids = [artist['id'] for artist in profile_info['top_artists']['items']]
-        track_ids = [track['id'] for track in profile_info['top_tracks']['items']]
-        avg_audio_features = fetch_average_audio_features(track_ids)
-        top_genres = fetch_top_genres(profile_info)
-
-        # Save data in the session
-        credentials['avg_audio_features'] = avg_audio_features  # Saves user average audio features
-        credentials['top_artists'] = artist_ids                # Saves user top artists
-        credentials['top_genres'] = top_genres                 # Saves user top genres
-        credentials['user_id'] = profile_info['profile']['id']
+        # Save the user's taste snapshot, the session only keeps the user ID
+        save_credentials(user_id=profile_info['profile']['id'])
+        taste_snapshots.put(credentials['user_id'], taste_from_profile(profile_info, avg_audio_features))
 
         response = jsonify(profile_info)
         return add_cors_headers(response)
     
     except Exception as e:
-        print(f"Error: {str(e)}")  # Print the exception message
+        log_error(str(e))
         response = jsonify({"message": f"Unable to retrieve user profile. {str(e)}"})
+        return add_cors_headers(response), 500
     
-# no refresh token since we are using credentials object instead of session
-'''@application.route('/refresh-token')
-def refresh_token():
-    try:
-        if 'refresh_token' not in session:
-            return redirect('/login')
-        if datetime.datetime.now().timestamp() > session['expires_at']: # session is expired, redirect to refresh token
-            req_body = {
-                'grant_type': 'refresh_token',
-                'refresh_token': session['refresh_token'],
-                'client_id': CLIENT_ID,
-                'client_secret': CLIENT_SECRET,
-            }
-            response = requests.post(TOKEN_URL, data=req_body) # generate new token
-            new_token_info = response.json()
-            session['access_token'] = new_token_info['access_token']
-            session['expires_at'] = datetime.datetime.now().timestamp() + new_token_info['expires_in']
-            return redirect('http://localhost:5173/profile')
-    except Exception as e:
-        print(f"Error: {str(e)}")  # Print the exception message
-        return jsonify({"message": f"Unable to refresh authentication token. {str(e)}"}), 500'''
+# no refresh-token route, expired tokens are refreshed transparently by the Spotify client (see refresh_auth)
        
 # logout/switch user
 @application.route('/logout')
 def logout():
     try:
-        # session.clear() # clear session, redirect to login page
-        credentials.clear()
+        clear_credentials() # clear session, redirect to login page
         return jsonify({"message": "Logged out successfully"}), 200
     except Exception as e:
-        print(f"Error: {str(e)}")  # Print the exception message
+        log_error(str(e))
         return jsonify({"message": f"Logout failed. {str(e)}"}), 500
 
 # builds new playlist for user on submit btn
@@ -221,29 +858,28 @@ def recommendations():
         response = jsonify({"message": "CORS preflight request"})
         response.headers.add('Access-Control-Allow-Origin', '*')  # Allow all origins, you can change '*' to specific domains
         response.headers.add('Access-Control-Allow-Methods', 'POST, OPTIONS')  # Allow POST and OPTIONS methods
-        response.headers.add('Access-Control-Allow-Headers', 'Content-Type, Authorization')  # Allow specific headers
+        response.headers.add('Access-Control-Allow-Headers', 'Content-Type, Authorization, X-Session')  # Allow specific headers
         return response
     
     try:
         if 'access_token' not in credentials:  # Check if the user is authenticated
             return redirect('/login')
-        '''if datetime.datetime.now().timestamp() > session['expires_at']:  # Check if the access token is expired
-            return redirect('/refresh-token')'''
         data = request.json
-        activity = data.get('activity')  # selected activity from user on front end
+        activity = normalize_activity(data.get('activity'))  # selected activity from user on front end
         num_of_songs = 100
-        playlist_keywords = keywords[activity]
-        playlists = fetch_user_playlists()
-        #print(f'PLAYLISTS: {playlists}')
-        matching_playlists = [playlist['id'] for playlist in playlists if any(keyword in playlist['name'].lower() for keyword in playlist_keywords)]
-        seed_artists, seed_genres = build_seed_arrays(matching_playlists, activity)
+        project = track_projection(data.get('fields') or request.args.get('fields'))
+        taste = current_taste()
+        matching_playlists = match_playlists(user_playlist_index(), activity)
+        seed_artists, seed_genres = build_seed_arrays(matching_playlists, activity, taste)
         #print(f'SEED ARTISTS: {seed_artists}')
-        recommendations = get_recommendations(seed_artists, seed_genres, num_of_songs, activity)
+        batches = rank_recommendations(seed_artists, seed_genres, matching_playlists, activity, taste, num_of_songs)
+        if wants_ndjson(request.headers.get('Accept')): # one track per line, flushed batch by batch as tracks are hydrated
+            return ndjson_response(batches, project)
         #print(f'RECS: {recommendations}')
-        response = jsonify(recommendations)
+        response = jsonify([project(track) for batch in batches for track in batch])
         return response
     except Exception as e:
-        print(f"Error: {str(e)}")  # Print the exception message
+        log_error(str(e))
         return jsonify({"message": f"Unable to get song recommendations. {str(e)}"}), 500
 
   
@@ -253,60 +889,197 @@ def build():
     try:
         if 'access_token' not in credentials:  # Check if the user is authenticated
             return redirect('/login')
-        '''if datetime.datetime.now().timestamp() > session['expires_at']:  # Check if the access token is expired
-            return redirect('/refresh-token')'''
         data = request.json
         playlist_name = data.get('name')
         playlist_songs = data.get('songs')
-        res = ''
         playlist_id = create_spotify_playlist(playlist_name)
-        if playlist_id:
-            response = add_songs_to_playlist(playlist_id, playlist_songs)                
-        return jsonify(response)
+        chunks = add_songs_to_playlist(playlist_id, playlist_songs)
+        expire_playlist_index(playlist_index_key(credentials.get('user_id'), g.sid)) # the new playlist may match an activity
+        return jsonify(build_result(playlist_id, chunks))
     except Exception as e:
-        print(f"Error: {str(e)}")  # Print the exception message
+        log_error(str(e))
         return jsonify({"message": f"Unable to build playlist. {str(e)}"}), 500
 
 
 # HELPER FUNCTIONS
 
 
+def service_stats(): # everything /stats reports, /metrics exposes the numeric values as gauges
+    return {
+        **{name: client.stats() for name, client in http_clients.items()},
+        'rate_limiter': spotify_limiter.stats(),
+        'cache': {cache.name: cache.stats() for cache in (artist_genre_cache, playlist_tracks_cache, audio_feature_cache, playlist_index_cache, taste_snapshots.store, user_sessions)},
+        'seed_pool': seed_pool.stats(),
+        'taste_snapshots': taste_snapshots.stats(),
+        'singleflight': {name: flight.stats() for name, flight in singleflights.items()},
+    }
+
 def add_cors_headers(response):
     response.headers.add('Access-Control-Allow-Origin', 'https://main.d30okcwstuwyij.amplifyapp.com')
     response.headers.add('Access-Control-Allow-Credentials', 'true')
-    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization')
+    response.headers.add('Access-Control-Allow-Headers', 'Content-Type,Authorization,X-Session')
     response.headers.add('Access-Control-Allow-Methods', 'GET,POST,OPTIONS')
     return response
 
-def fetch_average_audio_features(track_ids): # finds and returns average audio features upon user login
-    url = f"{API_BASE_URL}audio-features"
-    headers = {'Authorization': f"Bearer {credentials.get('access_token')}"}
-    params = {'ids': ','.join(track_ids)}
-    response = requests.get(url, headers=headers, params=params)
+def track_projection(fields): # 'compact' trims tracks to what the frontend reads, anything else keeps Spotify's objects
+    return compact_track if fields == 'compact' else (lambda track: track)
+
+def compact_track(track): # id, uri, name, artists, album art, duration and preview, at the paths of the full object
+    return {
+        'id': track['id'],
+        'uri': track.get('uri'),
+        'name': track.get('name'),
+        'artists': [{'id': artist.get('id'), 'name': artist.get('name')} for artist in track.get('artists', [])],
+        'album': {'images': [{'url': image.get('url')} for image in (track.get('album') or {}).get('images', [])]},
+        'duration_ms': track.get('duration_ms'),
+        'preview_url': track.get('preview_url'),
+    }
+
+def wants_ndjson(accept):
+    return 'application/x-ndjson' in (accept or '')
+
+def ndjson_lines(batches, project): # one encoded chunk per batch of tracks
+    for batch in batches:
+        yield ''.join(json.dumps(project(track), separators=(',', ':')) + '\n' for track in batch).encode()
+
+def ndjson_response(batches, project):
+    encoding = choose_encoding(request.headers.get('Accept-Encoding'))
+    compressor = StreamCompressor(encoding)
+    scope = g.pop('request_scope', None) # ended once the body is sent, so the hydration it streams is measured and traced
+    def body():
+        error = None
+        try:
+            for chunk in ndjson_lines(batches, project):
+                yield compressor.compress(chunk)
+            yield compressor.finish()
+        except Exception as e:
+            error = str(e)
+            raise
+        finally:
+            if scope is not None:
+                end_request(scope, 500 if error else 200, error)
+    response = Response(stream_with_context(body()), mimetype='application/x-ndjson')
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    if scope is not None:
+        response.headers['X-Request-ID'] = scope.request_id
+    return response
+
+def in_context(fn): # wraps fn to run on another thread with the caller's g (auth headers included) and trace
+    auth_headers()
+    state = dict(vars(g))
+    state.pop('request_scope', None) # only the request's own thread ends it
+    context = contextvars.copy_context()
+    def run(*args):
+        with application.app_context():
+            vars(g).update(state)
+            return context.run(fn, *args)
+    return run
+
+def submit_in_context(executor, fn, *args):
+    return executor.submit(in_context(fn), *args)
+
+def run_with_app_token(fn, *args): # for background jobs that run outside any user's request
+    with application.app_context():
+        g.app_auth = True
+        g.spotify_headers = app_auth_headers()
+        return fn(*args)
+
+def fetch_json(endpoint, params=None): # parsed JSON of a GET, shared with identical requests already in flight
+    return spotify_flights.do(flight_key(endpoint, params, auth_headers()['Authorization']), get_json, endpoint, params)
+
+def get_json(endpoint, params=None):
+    response = spotify.get(endpoint, params=params)
     if not response.ok:
-        raise ValueError(f"Failed to fetch audio features from Spotify API: {response.status_code} - {response.text}")
+        raise ValueError(f"API response was not ok. Failed to fetch {endpoint}")
+    return response.json()
+
+def flight_key(endpoint, params, scope):
+    '''Coalescing key of a GET: its path and sorted query, inline or passed as params.
+
+    Most of what the app reads (search, playlists, artists, tracks, audio features) is the same
+    for every user, so those keys are shared across sessions. `me` endpoints and market=from_token
+    answers depend on the token's user and are keyed by the token (scope) as well.
+    '''
+    path, _, query = endpoint.partition('?')
+    items = tuple(sorted(urllib.parse.parse_qsl(query) + [(name, str(value)) for name, value in (params or {}).items()]))
+    path = path.strip('/')
+    user_dependent = path == 'me' or path.startswith('me/') or ('market', 'from_token') in items
+    return (path, items, scope if user_dependent else None)
+
+def current_user_id(): # Spotify user ID, looked up once per session if /profile hasn't run
+    if 'user_id' not in credentials:
+        save_credentials(user_id=fetch_json('me')['id'])
+    return credentials['user_id']
+
+@traced
+def current_taste():
+    '''The requesting user's taste snapshot, stale-while-revalidate.
+
+    Only a user without any snapshot waits for one to be computed, a stale snapshot is
+    returned as is while a background thread recomputes it.
+    '''
+    user_id = current_user_id()
+    snapshot = taste_snapshots.get(user_id)
+    if snapshot is None:
+        snapshot = compute_taste()
+        taste_snapshots.put(user_id, snapshot)
+    elif taste_snapshots.is_stale(snapshot) and taste_snapshots.begin_refresh(user_id):
+        threading.Thread(target=in_context(refresh_taste), args=(user_id,), daemon=True).start()
+    return snapshot
+
+def refresh_taste(user_id):
+    try:
+        taste_snapshots.put(user_id, compute_taste())
+    except Exception as e:
+        log_error(f"Taste refresh for {user_id} failed. {str(e)}")
+    finally:
+        taste_snapshots.end_refresh(user_id)
+
+@traced
+def compute_taste(): # top artists and tracks concurrently, then the tracks' audio features
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        endpoints = {'top_artists': 'me/top/artists', 'top_tracks': 'me/top/tracks'}
+        futures = {key: submit_in_context(executor, fetch_json, endpoint) for key, endpoint in endpoints.items()}
+        profile_info = {key: future.result(timeout=PROFILE_CALL_DEADLINE) for key, future in futures.items()}
+    track_ids = [track['id'] for track in profile_info['top_tracks']['items']]
+    return taste_from_profile(profile_info, fetch_average_audio_features(track_ids))
+
+def taste_from_profile(profile_info, avg_audio_features):
+    return taste_snapshots.snapshot(
+        avg_audio_features,
+        [artist['id'] for artist in profile_info['top_artists']['items']],
+        fetch_top_genres(profile_info),
+    )
+
+@traced
+def fetch_average_audio_features(track_ids): # average audio features of the user's top tracks, None when Spotify has none
+    params = {'ids': ','.join(track_ids)}
+    response = spotify.get('audio-features', params=params)
+    if not response.ok: # the endpoint is restricted for newer apps, recommendations are then ranked without it
+        log_error(f"Failed to fetch audio features from Spotify API: {response.status_code} - {response.text}")
+        return None
     audio_features = response.json().get('audio_features', [])
-    data = []
+    return average_audio_features(audio_features) # average audio features for user
+
+def average_audio_features(audio_features): # single-pass mean per feature skipping missing tracks/values, None without any
+    totals = dict.fromkeys(AUDIO_FEATURES, 0.0)
+    counts = dict.fromkeys(AUDIO_FEATURES, 0)
     for feature in audio_features:
-        if feature:  # Ensure feature is not None
-            data.append({
-                'acousticness': feature['acousticness'],
-                'energy': feature['energy'],
-                'valence': feature['valence'],
-                'danceability': feature['danceability'],
-                'tempo': feature['tempo']
-            })
-        else:
-            raise ValueError(f"Unexpected response")
-    df = pd.DataFrame(data)
-    averages = {
-        'acousticness': round(df['acousticness'].mean(), 2),
-        'energy': round(df['energy'].mean(), 2),
-        'valence': round(df['valence'].mean(), 2),
-        'danceability': round(df['danceability'].mean(), 2),
-        'tempo': round(df['tempo'].mean(), 2)
-    }
-    return averages # average audio features for user
+        if not feature:  # tracks without analysis come back as null
+            continue
+        for name in AUDIO_FEATURES:
+            value = feature.get(name)
+            if value is not None:
+                totals[name] += value
+                counts[name] += 1
+    missing = [name for name in AUDIO_FEATURES if not counts[name]]
+    if missing:
+        log_error(f"Unexpected response, no values for {', '.join(missing)}")
+        return None
+    averages = {name: round(totals[name] / counts[name], 2) for name in AUDIO_FEATURES}
+    return averages
 
 def fetch_top_genres(profile_info, top_n=5):
     top_artists = profile_info.get("top_artists", {}).get("items", [])
@@ -319,80 +1092,137 @@ def fetch_top_genres(profile_info, top_n=5):
     top_genres = genre_counter.most_common(top_n)
     return [genre for genre, count in top_genres] # return top genre for user
 
-def build_seed_arrays(matching_playlists, activity):
+def match_playlists(index, activity): # (id, snapshot_id) of the user's playlists named for the activity
+    return [(playlist_id, entry['snapshot_id']) for playlist_id, entry in index.items() if activity in entry['activities']]
+
+@traced
+def user_playlist_index():
+    '''{playlist_id: {'snapshot_id', 'activities'}} for the requesting user, shared by every activity.
+
+    Served from the cache while fresh, re-listing only after PLAYLIST_INDEX_REFRESH.
+    '''
+    index_key = playlist_index_key(credentials.get('user_id'), g.sid)
+    cached = playlist_index_cache.get(index_key)
+    if cached and cached['built_at'] + PLAYLIST_INDEX_REFRESH > time.time():
+        return cached['playlists']
+    index = index_playlists(fetch_user_playlists(), cached['playlists'] if cached else None)
+    playlist_index_cache.set(index_key, {'built_at': time.time(), 'playlists': index})
+    return index
+
+def playlist_index_key(user_id, sid):
+    return user_id or f"session:{sid}"
+
+def index_playlists(playlists, previous=None): # entries whose snapshot_id is unchanged are reused as is
+    previous = previous or {}
+    index = {}
+    for playlist in playlists:
+        if not playlist:
+            continue
+        entry = previous.get(playlist['id'])
+        if not entry or entry['snapshot_id'] != playlist.get('snapshot_id'):
+            entry = {'snapshot_id': playlist.get('snapshot_id'), 'activities': sorted(activity_matcher.activities(playlist['name']))}
+        index[playlist['id']] = entry
+    return index
+
+def expire_playlist_index(index_key): # the next request re-lists, still reusing unchanged entries
+    cached = playlist_index_cache.get(index_key)
+    if cached:
+        cached['built_at'] = 0
+        playlist_index_cache.set(index_key, cached)
+
+def add_unique_item(target_array, source_array):
+    # Create a set of available items, excluding items already in target_array
+    available_items = set(source_array) - set(target_array)
+    if available_items:
+        target_array.append(random.choice(list(available_items)))
+
+@traced
+def build_seed_arrays(matching_playlists, activity, taste):
     seed_artists = []  # We want 2 total (1 from user, 1 from popular)
     seed_genres = []   # We want 3 total (2 from user, 1 from popular)
 
-    def add_unique_item(target_array, source_array):
-        # Create a set of available items, excluding items already in target_array
-        available_items = set(source_array) - set(target_array)
-        if available_items:
-            target_array.append(random.choice(list(available_items)))
-
     if matching_playlists:
         sample_playlist = random.choice(matching_playlists)
-        top_artist_and_genre = get_top_artist_and_genre(sample_playlist)
+        top_artist_and_genre = get_top_artist_and_genre(*sample_playlist)
         seed_artists.append(top_artist_and_genre['artist'])
         seed_genres.append(top_artist_and_genre['genre'])
     else:
-        add_unique_item(seed_artists, credentials['top_artists'])
-        add_unique_item(seed_genres, credentials['top_genres'])
+        add_unique_item(seed_artists, taste['top_artists'])
+        add_unique_item(seed_genres, taste['top_genres'])
 
-    add_unique_item(seed_genres, credentials['top_genres'])
+    add_unique_item(seed_genres, taste['top_genres'])
 
     # Select a unique popular artist and genre that aren't already in seeds
-    while True:
-        sample_popular_playlist = random_popular_playlist(activity)
-        top_artist_and_genre = get_top_artist_and_genre(sample_popular_playlist)
+    seed_pool.ensure_fresh(activity)
+    candidate = seed_pool.sample(activity, seed_artists, seed_genres)
+    for _ in range(0 if candidate else SEED_MAX_ATTEMPTS): # pool is cold or every candidate collides
+        try:
+            sample_popular_playlist = random_popular_playlist(activity)
+            top_artist_and_genre = get_top_artist_and_genre(*sample_popular_playlist)
+        except Exception as e: # a failed draw uses up its attempt, the user's own history is the fallback
+            log_error(f"Popular seed draw failed. {str(e)}")
+            continue
+        seed_pool.add(activity, {'playlist_id': sample_popular_playlist[0], **top_artist_and_genre})
         if top_artist_and_genre['artist'] not in seed_artists and top_artist_and_genre['genre'] not in seed_genres:
+            candidate = top_artist_and_genre
             break
 
-    seed_artists.append(top_artist_and_genre['artist'])
-    seed_genres.append(top_artist_and_genre['genre'])
+    if candidate:
+        seed_artists.append(candidate['artist'])
+        seed_genres.append(candidate['genre'])
+    else: # fall back to the user's own listening history
+        add_unique_item(seed_artists, taste['top_artists'])
+        add_unique_item(seed_genres, taste['top_genres'])
 
+    if len(seed_artists) < 2 or len(seed_genres) < 3:
+        raise ValueError("Not enough unique artists and genres to seed recommendations")
     return seed_artists, seed_genres
 
-def fetch_user_playlists(): # returns all user playlists
-    url = f"{API_BASE_URL}me/playlists"
-    headers = {'Authorization': f"Bearer {credentials.get('access_token')}"}
-    response = requests.get(url, headers=headers)
-    if not response.ok:
-        raise ValueError(f"Failed to fetch user playlists for analysis")
-    return response.json()['items']
-    
-from collections import Counter
-import requests
+def fetch_user_playlists(): # yields all user playlists, page by page
+    return paginate('me/playlists', limit=50)
 
-def get_top_artist_and_genre(playlist_id):
-    url = f"{API_BASE_URL}playlists/{playlist_id}/tracks"
-    headers = {'Authorization': f"Bearer {credentials.get('access_token')}"}
-    response = requests.get(url, headers=headers)
-    if not response.ok:
-        raise ValueError("Failed to analyze artist and genre information from playlists")
-    tracks = response.json().get("items", [])
-    if not tracks:
-        raise ValueError("Could not find playlists to analyze")
+def paginate(endpoint, limit, params=None, max_items=None):
+    '''Yields every item of a Spotify paging object.
+
+    The first page reveals `total`, after which the remaining offsets are fetched concurrently,
+    PAGINATION_MAX_WORKERS pages ahead of the consumer, and yielded in order. Closing the
+    generator early cancels the pages that haven't been requested yet.
+    '''
+    params = dict(params or {}, limit=limit)
+    first_page = fetch_page(endpoint, params, 0)
+    yield from first_page['items']
+    total = first_page.get('total', 0) if max_items is None else min(first_page.get('total', 0), max_items)
+    if total <= limit:
+        return
+    offsets = iter(range(limit, total, limit))
+    executor = ThreadPoolExecutor(max_workers=PAGINATION_MAX_WORKERS)
+    try:
+        window = deque(submit_in_context(executor, fetch_page, endpoint, params, offset) for offset in islice(offsets, PAGINATION_MAX_WORKERS))
+        while window:
+            page = window.popleft().result()
+            offset = next(offsets, None)
+            if offset is not None:
+                window.append(submit_in_context(executor, fetch_page, endpoint, params, offset))
+            yield from page['items']
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def fetch_page(endpoint, params, offset):
+    return fetch_json(endpoint, {**params, 'offset': offset})
     
-    artist_count = Counter()
+@traced
+def get_top_artist_and_genre(playlist_id, snapshot_id=None):
+    artist_ids = [artist_id for _, artist_id in fetch_playlist_tracks(playlist_id, snapshot_id)]
+    if not artist_ids:
+        raise ValueError("Could not find playlists to analyze")
+
+    return top_artist_and_genre(artist_ids, fetch_artist_genres(list(set(artist_ids))))
+
+def top_artist_and_genre(artist_ids, genres_by_artist): # most frequent artist and genre in a playlist
+    artist_count = Counter(artist_ids)
     genre_count = Counter()
-    artist_ids = []
-
-    for item in tracks:
-        artist_id = item['track']['artists'][0]['id']
-        artist_count[artist_id] += 1
-        artist_ids.append(artist_id)
-
-    # Fetch genres for all artists in a single request (up to 50 IDs at a time)
-    unique_artist_ids = list(set(artist_ids))
-    for i in range(0, len(unique_artist_ids), 20):
-        batch_ids = unique_artist_ids[i:i+20]
-        artist_url = f"https://api.spotify.com/v1/artists?ids={','.join(batch_ids)}"
-        artist_response = requests.get(artist_url, headers=headers)
-        if not artist_response.ok:
-            raise ValueError("Failed to retrieve artist genre information")
-        artists_info = artist_response.json().get("artists", [])
-        for artist_info in artists_info:
-            genre_count.update(artist_info.get("genres", []))
+    for genres in genres_by_artist.values():
+        genre_count.update(genres)
 
     # Determine top artist and top genre
     top_artist = artist_count.most_common(1)[0][0] if artist_count else None
@@ -403,71 +1233,274 @@ def get_top_artist_and_genre(playlist_id):
 
     return {"artist": top_artist, "genre": top_genre}
 
-def random_popular_playlist(search_term): # find random popular playlist related to selected activity
-    url = f"{API_BASE_URL}search"
+@traced
+def fetch_playlist_tracks(playlist_id, snapshot_id=None): # [track_id, first artist_id] pairs, cached per playlist snapshot
+    cache_key = f"{playlist_id}:{snapshot_id or ''}"
+    pairs = playlist_tracks_cache.get(cache_key)
+    if pairs is not None:
+        return pairs
+    tracks = paginate(f"playlists/{playlist_id}/tracks", limit=100, params={'fields': PLAYLIST_TRACK_FIELDS}, max_items=PLAYLIST_TRACKS_LIMIT)
+    pairs = track_pairs(item.get('track') for item in tracks if item)
+    if pairs:
+        playlist_tracks_cache.set(cache_key, pairs)
+    return pairs
+
+def track_pairs(tracks): # local files and removed tracks have no track or artist ID
+    return [
+        [track['id'], track['artists'][0]['id']] for track in tracks
+        if track and track.get('id') and track.get('artists') and track['artists'][0].get('id')
+    ]
+
+@traced
+def fetch_artist_genres(artist_ids): # returns {artist_id: genres}, only uncached artists hit the API
+    genres_by_artist = artist_genre_cache.get_many(artist_ids)
+    missing_ids = [artist_id for artist_id in artist_ids if artist_id not in genres_by_artist]
+
+    # Fetch genres for missing artists, batches of up to 50 IDs dispatched concurrently
+    batches = [missing_ids[i:i+ARTIST_BATCH_SIZE] for i in range(0, len(missing_ids), ARTIST_BATCH_SIZE)]
+    if len(batches) > 1:
+        with ThreadPoolExecutor(max_workers=min(len(batches), ARTIST_MAX_WORKERS)) as executor:
+            futures = [submit_in_context(executor, fetch_artist_batch, batch_ids) for batch_ids in batches]
+            batch_results = [future.result() for future in futures]
+    else:
+        batch_results = [fetch_artist_batch(batch_ids) for batch_ids in batches]
+
+    fetched = {}
+    for artists_info in batch_results:
+        for artist_info in artists_info:
+            if artist_info: # unknown IDs come back as null
+                fetched[artist_info['id']] = artist_info.get("genres", [])
+    artist_genre_cache.set_many(fetched)
+    genres_by_artist.update(fetched)
+    return genres_by_artist
+
+def fetch_artist_batch(batch_ids): # returns artist objects for up to 50 IDs
+    return fetch_json('artists', {'ids': ','.join(batch_ids)}).get("artists", [])
+
+def search_popular_playlists(search_term): # returns (id, snapshot_id) of popular playlists related to selected activity
     params = {
         'q': search_term, # activity
         'type': 'playlist',  # search for playlists
         'limit': 20
     }
-    headers = {'Authorization': f"Bearer {credentials.get('access_token')}"}
-    response = requests.get(url, headers=headers, params=params)
-    if not response.ok:
-        raise ValueError(f"API response was not ok")        
-    playlists = response.json().get('playlists', {}).get('items', [])
+    playlists = fetch_json('search', params).get('playlists', {}).get('items', [])
+    return [(playlist['id'], playlist.get('snapshot_id')) for playlist in playlists if playlist]
+
+@traced
+def random_popular_playlist(search_term): # find random popular playlist related to selected activity
+    playlists = search_popular_playlists(search_term)
     if playlists:
-        selected_playlist = random.choice(playlists)
-        return selected_playlist['id']  # Return randomly selected playlist ID
+        return random.choice(playlists)  # Return randomly selected playlist ID and snapshot
     else:
         raise ValueError(f"No playlists found for analysis")
     
-def get_recommendations(seed_artists, seed_genres, num_of_songs, activity): # returns recommended tracks
-    base_url =  f'https://api.spotify.com/v1/recommendations?seed_artists={seed_artists[0]},{seed_artists[1]}&seed_genres={seed_genres[0]},{seed_genres[1]},{seed_genres[2]}&limit={num_of_songs}'
-    activity_params = target_features.get(activity, "")
-    formatted_params = activity_params.format(
-        energy=credentials['avg_audio_features']['energy'],
-        tempo=credentials['avg_audio_features']['tempo'],
-        danceability=credentials['avg_audio_features']['danceability'],
-        valence=credentials['avg_audio_features']['valence'],
-        acousticness=credentials['avg_audio_features']['acousticness'],
+@traced
+def rank_recommendations(seed_artists, seed_genres, matching_playlists, activity, taste, num_of_songs):
+    '''Top tracks for the activity, ranked locally over a pool of candidates.
+
+    The pool is Spotify's own recommendations (when the endpoint still answers), the seed artists'
+    top tracks and up to RANK_MAX_PLAYLISTS of the user's matched playlists, all fetched concurrently.
+    Without audio features in the taste snapshot the pool keeps its order instead (see
+    capped_pool_order). Returns an iterator of track lists in rank order, see hydrated_batches.
+    '''
+    features = taste['features']
+    playlists = random.sample(matching_playlists, min(len(matching_playlists), RANK_MAX_PLAYLISTS))
+    with ThreadPoolExecutor(max_workers=PROFILE_MAX_WORKERS) as executor:
+        recommended = submit_in_context(executor, get_recommendations, seed_artists, seed_genres, num_of_songs, activity, features)
+        top_tracks = [submit_in_context(executor, fetch_artist_top_tracks, artist_id) for artist_id in seed_artists]
+        playlist_tracks = [submit_in_context(executor, fetch_playlist_tracks, *playlist) for playlist in playlists]
+        known_tracks = {}
+        for future in (recommended, *top_tracks):
+            for track in result_or_empty(future):
+                known_tracks.setdefault(track['id'], track)
+        playlist_pairs = [pair for future in playlist_tracks for pair in result_or_empty(future)]
+    pool = candidate_pool(track_pairs(known_tracks.values()), playlist_pairs)
+    ranked_ids = rank_pool(pool, fetch_track_features([track_id for track_id, _ in pool]), activity, features, num_of_songs) if features else []
+    if not ranked_ids: # no audio features to rank with, keep the pool's order, Spotify's own picks first
+        ranked_ids = capped_pool_order(pool, num_of_songs)
+    return hydrated_batches(ranked_ids, known_tracks)
+
+def result_or_empty(future): # a failed candidate source shrinks the pool instead of failing the request
+    try:
+        return future.result(timeout=PROFILE_CALL_DEADLINE)
+    except Exception as e:
+        log_error(f"Candidate source failed. {str(e)}")
+        return []
+
+def candidate_pool(known_pairs, playlist_pairs): # unique [track_id, artist_id] pairs, capped at RANK_POOL_SIZE
+    pool = {}
+    for track_id, artist_id in known_pairs:
+        pool.setdefault(track_id, artist_id)
+    extra = [pair for pair in playlist_pairs if pair[0] not in pool]
+    if len(pool) + len(extra) > RANK_POOL_SIZE:
+        extra = random.sample(extra, max(RANK_POOL_SIZE - len(pool), 0))
+    for track_id, artist_id in extra:
+        pool.setdefault(track_id, artist_id)
+    return list(pool.items())
+
+def rank_pool(pool, features_by_track, activity, avg_audio_features, limit): # ranked track IDs of the pool
+    scored = [(track_id, artist_id) for track_id, artist_id in pool if features_by_track.get(track_id)]
+    return rank(
+        [track_id for track_id, _ in scored],
+        [artist_id for _, artist_id in scored],
+        [features_by_track[track_id] for track_id, _ in scored],
+        Constraints(AUDIO_FEATURES, activity_constraints(activity, avg_audio_features)),
+        [avg_audio_features[name] for name in AUDIO_FEATURES],
+        limit,
+        RANK_PER_ARTIST,
     )
-    url = f"{base_url}&{formatted_params}"
-    headers = {'Authorization': f"Bearer {credentials.get('access_token')}"}
-    response = requests.get(url, headers=headers)
+
+def capped_pool_order(pool, limit): # track IDs of the pool in order, at most RANK_PER_ARTIST per artist
+    per_artist = Counter()
+    picked = []
+    for track_id, artist_id in pool:
+        if len(picked) == limit:
+            break
+        if per_artist[artist_id] < RANK_PER_ARTIST:
+            per_artist[artist_id] += 1
+            picked.append(track_id)
+    return picked
+
+@traced
+def fetch_track_features(track_ids): # {track_id: AUDIO_FEATURES vector}, only uncached tracks hit the API
+    features_by_track = audio_feature_cache.get_many(track_ids)
+    missing_ids = [track_id for track_id in track_ids if track_id not in features_by_track]
+    batches = [missing_ids[i:i+AUDIO_FEATURES_BATCH_SIZE] for i in range(0, len(missing_ids), AUDIO_FEATURES_BATCH_SIZE)]
+    with ThreadPoolExecutor(max_workers=max(min(len(batches), ARTIST_MAX_WORKERS), 1)) as executor:
+        futures = [submit_in_context(executor, fetch_json, f"audio-features?ids={','.join(batch_ids)}") for batch_ids in batches]
+        fetched = {}
+        for batch_ids, future in zip(batches, futures):
+            audio_features = result_or_empty(future)
+            if audio_features: # failed batches aren't cached, the next request retries them
+                fetched.update(zip(batch_ids, map(feature_vector, audio_features.get('audio_features', []))))
+    audio_feature_cache.set_many(fetched)
+    features_by_track.update(fetched)
+    return {track_id: vector for track_id, vector in features_by_track.items() if vector}
+
+def feature_vector(audio_features): # [] when the track has no analysis
+    if not audio_features or any(audio_features.get(name) is None for name in AUDIO_FEATURES):
+        return []
+    return [audio_features[name] for name in AUDIO_FEATURES]
+
+def fetch_artist_top_tracks(artist_id):
+    return fetch_json(f"artists/{artist_id}/top-tracks?market=from_token").get('tracks', [])
+
+def hydrated_batches(track_ids, known_tracks):
+    '''Full track objects in track_ids order, one list per TRACKS_BATCH_SIZE positions.
+
+    The unknown tracks of every batch are fetched concurrently, and each batch is yielded as soon as
+    it and the batches before it have arrived. Tracks of a failed batch are left out.
+    '''
+    batches = [track_ids[i:i+TRACKS_BATCH_SIZE] for i in range(0, len(track_ids), TRACKS_BATCH_SIZE)]
+    with ThreadPoolExecutor(max_workers=max(min(len(batches), ARTIST_MAX_WORKERS), 1)) as executor:
+        futures = [submit_in_context(executor, fetch_tracks, [track_id for track_id in batch if track_id not in known_tracks]) for batch in batches]
+        for batch, future in zip(batches, futures):
+            fetched = result_or_empty(future) or {}
+            yield [track for track in (known_tracks.get(track_id) or fetched.get(track_id) for track_id in batch) if track]
+
+@traced
+def fetch_tracks(track_ids): # {track_id: track} for up to TRACKS_BATCH_SIZE IDs
+    if not track_ids:
+        return {}
+    return {track['id']: track for track in fetch_json(f"tracks?ids={','.join(track_ids)}").get('tracks', []) if track}
+
+@traced
+def get_recommendations(seed_artists, seed_genres, num_of_songs, activity, avg_audio_features): # returns recommended tracks
+    url = recommendations_url(seed_artists, seed_genres, num_of_songs, activity, avg_audio_features)
+    response = spotify.get(url)
     if not response.ok:
         raise ValueError(f"API response was not ok")
     recommendations = response.json().get('tracks', [])
     return recommendations
 
+def recommendations_url(seed_artists, seed_genres, num_of_songs, activity, avg_audio_features):
+    base_url =  f'recommendations?seed_artists={seed_artists[0]},{seed_artists[1]}&seed_genres={seed_genres[0]},{seed_genres[1]},{seed_genres[2]}&limit={num_of_songs}'
+    if not avg_audio_features: # the activity's constraints are relative to the user's averages
+        return base_url
+    return f"{base_url}&{activity_constraints(activity, avg_audio_features)}"
+
+def activity_constraints(activity, avg_audio_features): # the activity's min_/max_/target_ query, filled with the user's averages
+    activity_params = target_features.get(activity, "")
+    return activity_params.format(
+        energy=avg_audio_features['energy'],
+        tempo=avg_audio_features['tempo'],
+        danceability=avg_audio_features['danceability'],
+        valence=avg_audio_features['valence'],
+        acousticness=avg_audio_features['acousticness'],
+    )
+
+@traced
 def create_spotify_playlist(playlist_name):
-    url = f"{API_BASE_URL}users/{credentials['user_id']}/playlists"
-    headers = {
-        "Authorization": f"Bearer {credentials.get('access_token')}",
-        "Content-Type": "application/json"
-    }
-    data = {
-        "name": playlist_name,
-        "description": "Created via the Spotify API",
-        "public": False
-    }
-    response = requests.post(url, headers=headers, json=data)
+    url = f"users/{current_user_id()}/playlists"
+    data = new_playlist_body(playlist_name)
+    response = spotify.post(url, json=data) # json= sets the Content-Type header
     if not response.ok:
         raise ValueError(f"API response was not ok")
     return response.json()["id"]  # Playlist ID needed for the next step
     
-def add_songs_to_playlist(playlist_id, track_uris):
-    url = f"{API_BASE_URL}playlists/{playlist_id}/tracks"
-    headers = {
-        "Authorization": f"Bearer {credentials.get('access_token')}",
-        "Content-Type": "application/json"
+def new_playlist_body(playlist_name):
+    return {
+        "name": playlist_name,
+        "description": "Created via the Spotify API",
+        "public": False
     }
-    data = {
-        "uris": track_uris  # Array of Spotify track URIs
+
+@traced
+def add_songs_to_playlist(playlist_id, track_uris): # inserts in API-sized chunks, returns per-chunk timing
+    # Chunks go out one after another: Spotify rejects a position past the playlist's current
+    # length, so a chunk can only be placed once every chunk before it has landed. A 5xx or network
+    # error doesn't say whether Spotify applied the chunk, so the playlist's length is checked
+    # before each retry, a chunk that did land is never inserted twice.
+    url = f"playlists/{playlist_id}/tracks"
+    chunks = []
+    for data in track_chunks(track_uris):
+        start = time.perf_counter()
+        landed = False
+        for attempt in range(1, BUILD_CHUNK_RETRIES + 2):
+            if attempt > 1:
+                landed = chunk_landed(get_json(url, {'fields': 'total', 'limit': 1}).get('total', 0), data)
+                if landed:
+                    break
+            try:
+                response = spotify.post(url, json=data)
+            except requests.RequestException:
+                response = None
+            if response is not None and (response.ok or not retryable_status(response.status_code)):
+                break
+        if not landed and (response is None or not response.ok):
+            raise ValueError(f"API response was not ok. Failed to add tracks {chunk_range(data)} to playlist")
+        chunks.append(chunk_timing(data, attempt, start))
+    return chunks
+
+def track_chunks(track_uris): # add-items request bodies, each pinned to its final position
+    return [
+        {"uris": track_uris[position:position+PLAYLIST_CHUNK_SIZE], "position": position}  # Array of Spotify track URIs
+        for position in range(0, len(track_uris), PLAYLIST_CHUNK_SIZE)
+    ]
+
+def retryable_status(status_code): # 429s are already retried by the client
+    return status_code >= 500
+
+def chunk_landed(total, data): # the playlist is new, so only its earlier chunks or this one can be in it
+    if total == data['position'] + len(data['uris']):
+        return True
+    if total == data['position']:
+        return False
+    raise ValueError(f"Playlist has {total} tracks, unable to tell whether tracks {chunk_range(data)} were added")
+
+def chunk_range(data):
+    return f"{data['position']}-{data['position'] + len(data['uris']) - 1}"
+
+def chunk_timing(data, attempts, start):
+    return {
+        'position': data['position'],
+        'tracks': len(data['uris']),
+        'attempts': attempts,
+        'ms': round((time.perf_counter() - start) * 1000, 2),
     }
-    response = requests.post(url, headers=headers, json=data)
-    if not response.ok:
-        raise ValueError(f"API response was not ok. Failed to add tracks to playlist")
-    return("Tracks added successfully.")
+
+def build_result(playlist_id, chunks):
+    return {"message": "Tracks added successfully.", "playlist_id": playlist_id, "chunks": chunks}
 
 # Run the application
 if __name__ == "__main__":
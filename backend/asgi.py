@@ -0,0 +1,576 @@
+'''Async (ASGI) mode for the Spotify-bound routes.
+
+/profile, /recommendations and /build are served by the coroutines below on a shared
+httpx.AsyncClient, so a waiting request holds no thread and independent Spotify calls run
+under asyncio.gather. Every other route falls through to the Flask app unchanged. Sessions,
+caches and the seed pool are the same objects the sync routes use. Session, snapshot and cache
+reads and writes go through asyncio.to_thread, since a SQLite-backed store blocks on disk and on
+other workers' write locks.
+
+Select it at startup instead of `flask run`:
+
+    uvicorn asgi:app --host 0.0.0.0 --port 5000
+'''
+import asyncio
+import contextlib
+import random
+import time
+from collections import deque
+from itertools import islice
+
+import httpx
+from a2wsgi import WSGIMiddleware
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, RedirectResponse, StreamingResponse
+from starlette.routing import Mount, Route
+
+from compression import choose_encoding, compressible, compress, StreamCompressor
+from singleflight import AsyncSingleflight
+from telemetry import begin_request, end_request, trace_requested, traced, OutboundCall, endpoint_label, log_event, log_error
+from application import (
+    application, spotify, http_clients, unsign_session_id, SESSION_HEADER, singleflights, flight_key, user_sessions, seed_pool, taste_snapshots, artist_genre_cache, playlist_tracks_cache, audio_feature_cache,
+    CallStats, spotify_limiter, retry_after_seconds, token_expired, refresh_session_token, update_session,
+    average_audio_features, taste_from_profile, match_playlists, index_playlists, playlist_index_key, expire_playlist_index,
+    normalize_activity, track_pairs, playlist_index_cache, add_unique_item, candidate_pool, rank_pool, capped_pool_order, feature_vector,
+    top_artist_and_genre, recommendations_url, new_playlist_body, track_projection, wants_ndjson, ndjson_lines,
+    track_chunks, retryable_status, chunk_landed, chunk_range, chunk_timing, build_result, BUILD_CHUNK_RETRIES,
+    frontend_origin, frontend_test, backend_origin,
+    ARTIST_BATCH_SIZE, PROFILE_CALL_DEADLINE, SEED_MAX_ATTEMPTS, PAGINATION_MAX_WORKERS,
+    PLAYLIST_INDEX_REFRESH, PLAYLIST_TRACKS_LIMIT, PLAYLIST_TRACK_FIELDS,
+    RANK_MAX_PLAYLISTS, AUDIO_FEATURES_BATCH_SIZE, TRACKS_BATCH_SIZE,
+    SPOTIFY_POOL_SIZE, SPOTIFY_CONNECT_TIMEOUT, SPOTIFY_READ_TIMEOUT, SPOTIFY_MAX_RETRIES, SPOTIFY_MAX_RETRY_AFTER,
+)
+
+
+class AsyncSpotifyClient(CallStats):
+    '''httpx counterpart of SpotifyClient, one keep-alive connection pool per event loop.'''
+
+    def __init__(self, limiter, base_url, pool_size, connect_timeout, read_timeout, max_retries=3, max_retry_after=30):
+        super().__init__()
+        self.limiter = limiter
+        self.max_retries = max_retries
+        self.max_retry_after = max_retry_after
+        self.base_url = base_url
+        self.limits = httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size)
+        self.timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self.client = None
+
+    async def start(self):
+        self.client = httpx.AsyncClient(limits=self.limits, timeout=self.timeout)
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.aclose()
+
+    async def request(self, method, endpoint, auth, **kwargs):
+        '''Same retry policy as SpotifyClient.request: one refresh on 401, Retry-After on 429.'''
+        url = endpoint if endpoint.startswith('http') else self.base_url + endpoint
+        refreshed = False
+        with OutboundCall(method, endpoint_label(url, self.base_url)) as call:
+            for attempt in range(self.max_retries + 1):
+                token = auth.headers['Authorization']
+                await self.limiter.wait_async(token, self.max_retry_after)
+                call.attempts += 1
+                start = time.perf_counter()
+                try:
+                    response = await self.client.request(method, url, headers=auth.headers, **kwargs)
+                except httpx.HTTPError:
+                    self._record(time.perf_counter() - start, error=True)
+                    raise
+                self._record(time.perf_counter() - start, error=not response.is_success)
+                call.status, call.bytes = response.status_code, len(response.content)
+                if response.status_code == 401 and not refreshed:
+                    await auth.refresh(token)
+                    refreshed = True
+                    continue
+                if response.status_code == 429 and attempt < self.max_retries:
+                    retry_after = retry_after_seconds(response.headers)
+                    if retry_after <= self.max_retry_after: # only a wait we'll sit out holds back the other callers
+                        self.limiter.penalize(retry_after)
+                        continue
+                return response
+            return response
+
+    async def get(self, endpoint, auth, **kwargs):
+        return await self.request('GET', endpoint, auth, **kwargs)
+
+    async def post(self, endpoint, auth, **kwargs):
+        return await self.request('POST', endpoint, auth, **kwargs)
+
+
+async_spotify = AsyncSpotifyClient(
+    spotify_limiter,
+    spotify.base_url,
+    pool_size=SPOTIFY_POOL_SIZE,
+    connect_timeout=SPOTIFY_CONNECT_TIMEOUT,
+    read_timeout=SPOTIFY_READ_TIMEOUT,
+    max_retries=SPOTIFY_MAX_RETRIES,
+    max_retry_after=SPOTIFY_MAX_RETRY_AFTER,
+)
+http_clients['spotify_async'] = async_spotify
+async_flights = singleflights['spotify_async'] = AsyncSingleflight('spotify_async')
+
+
+# USER SESSIONS
+
+
+def load_user(request): # returns (session ID, stored user state) from the X-Session header or the Flask session cookie
+    sid = unsign_session_id(request.headers.get(SESSION_HEADER)) or unsign_session_id(request.cookies.get(application.config['SESSION_COOKIE_NAME']))
+    return sid, (user_sessions.get(sid, {}) if sid else {})
+
+class RequestAuth:
+    '''The requesting user's credentials, shared by every call the request makes.'''
+
+    def __init__(self, sid, user):
+        self.sid = sid
+        self.user = user
+        self.headers = {'Authorization': f"Bearer {user.get('access_token')}"}
+        self._lock = asyncio.Lock()
+
+    async def refresh(self, stale_token=None): # concurrent 401s for the same token refresh it only once
+        async with self._lock:
+            if stale_token and self.headers['Authorization'] != stale_token:
+                return
+            await asyncio.to_thread(refresh_session_token, self.sid, self.user, self.headers['Authorization'])
+            self.headers = {'Authorization': f"Bearer {self.user['access_token']}"}
+
+async def request_auth(request): # None when the request isn't logged in
+    sid, user = await asyncio.to_thread(load_user, request)
+    if 'access_token' not in user:
+        return None
+    auth = RequestAuth(sid, user)
+    if token_expired(user):
+        await auth.refresh()
+    return auth
+
+
+# API ENDPOINTS
+
+
+async def profile(request):
+    try:
+        auth = await request_auth(request)
+        if auth is None:
+            log_event('access_token_missing')
+            return RedirectResponse('/login', status_code=302)
+        user = auth.user
+
+        # Call each endpoint concurrently, audio features start as soon as top tracks arrive
+        tasks = {
+            'profile': asyncio.create_task(fetch_json(auth, 'me')),
+            'top_artists': asyncio.create_task(fetch_json(auth, 'me/top/artists')),
+            'top_tracks': asyncio.create_task(fetch_json(auth, 'me/top/tracks')),
+        }
+        try:
+            top_tracks = await asyncio.wait_for(tasks['top_tracks'], PROFILE_CALL_DEADLINE)
+            track_ids = [track['id'] for track in top_tracks['items']]
+            tasks['features'] = asyncio.create_task(fetch_average_audio_features(auth, track_ids))
+            results = await asyncio.wait_for(asyncio.gather(*tasks.values()), PROFILE_CALL_DEADLINE)
+        finally:
+            for task in tasks.values():
+                task.cancel()
+        profile_info = dict(zip(tasks, results))
+        avg_audio_features = profile_info.pop('features')
+
+        # Save the user's taste snapshot, the session only keeps the user ID
+        user['user_id'] = profile_info['profile']['id']
+        await asyncio.to_thread(update_session, auth.sid, {'user_id': user['user_id']})
+        await asyncio.to_thread(taste_snapshots.put, user['user_id'], taste_from_profile(profile_info, avg_audio_features))
+
+        return JSONResponse(profile_info)
+    except Exception as e:
+        log_error(str(e))
+        return JSONResponse({"message": f"Unable to retrieve user profile. {str(e)}"}, status_code=500)
+
+async def recommendations(request):
+    if request.method == 'OPTIONS':  # Preflight request without CORS headers, same reply as the Flask route
+        return JSONResponse({"message": "CORS preflight request"})
+    try:
+        auth = await request_auth(request)
+        if auth is None:  # Check if the user is authenticated
+            return RedirectResponse('/login', status_code=302)
+        data = await request.json()
+        activity = normalize_activity(data.get('activity'))  # selected activity from user on front end
+        num_of_songs = 100
+        project = track_projection(data.get('fields') or request.query_params.get('fields'))
+        taste = await current_taste(auth)
+        matching_playlists = match_playlists(await user_playlist_index(auth), activity)
+        seed_artists, seed_genres = await build_seed_arrays(auth, matching_playlists, activity, taste)
+        batches = await rank_recommendations(auth, seed_artists, seed_genres, matching_playlists, activity, taste, num_of_songs)
+        if wants_ndjson(request.headers.get('accept')):
+            return ndjson_response(request, batches, project)
+        return JSONResponse([project(track) async for batch in batches for track in batch])
+    except Exception as e:
+        log_error(str(e))
+        return JSONResponse({"message": f"Unable to get song recommendations. {str(e)}"}, status_code=500)
+
+async def build(request):
+    try:
+        auth = await request_auth(request)
+        if auth is None:  # Check if the user is authenticated
+            return RedirectResponse('/login', status_code=302)
+        data = await request.json()
+        user_id = await current_user_id(auth)
+        response = await async_spotify.post(f"users/{user_id}/playlists", auth, json=new_playlist_body(data.get('name')))
+        if not response.is_success:
+            raise ValueError("API response was not ok")
+        playlist_id = response.json()["id"]
+        chunks = await add_songs_to_playlist(auth, playlist_id, data.get('songs'))
+        await asyncio.to_thread(expire_playlist_index, playlist_index_key(user_id, auth.sid)) # the new playlist may match an activity
+        return JSONResponse(build_result(playlist_id, chunks))
+    except Exception as e:
+        log_error(str(e))
+        return JSONResponse({"message": f"Unable to build playlist. {str(e)}"}, status_code=500)
+
+
+# HELPER FUNCTIONS
+
+
+@traced
+async def add_songs_to_playlist(auth, playlist_id, track_uris): # chunks in order, see application.add_songs_to_playlist
+    url = f"playlists/{playlist_id}/tracks"
+    chunks = []
+    for data in track_chunks(track_uris):
+        start = time.perf_counter()
+        landed = False
+        for attempt in range(1, BUILD_CHUNK_RETRIES + 2):
+            if attempt > 1: # the failed attempt may have been applied, see application.add_songs_to_playlist
+                landed = chunk_landed((await get_json(auth, url, {'fields': 'total', 'limit': 1})).get('total', 0), data)
+                if landed:
+                    break
+            try:
+                response = await async_spotify.post(url, auth, json=data)
+            except httpx.HTTPError:
+                response = None
+            if response is not None and (response.is_success or not retryable_status(response.status_code)):
+                break
+        if not landed and (response is None or not response.is_success):
+            raise ValueError(f"API response was not ok. Failed to add tracks {chunk_range(data)} to playlist")
+        chunks.append(chunk_timing(data, attempt, start))
+    return chunks
+
+async def fetch_json(auth, endpoint, params=None): # async counterpart of application.fetch_json
+    return await async_flights.do(flight_key(endpoint, params, auth.headers['Authorization']), get_json, auth, endpoint, params)
+
+async def get_json(auth, endpoint, params=None):
+    response = await async_spotify.get(endpoint, auth, params=params)
+    if not response.is_success:
+        raise ValueError(f"API response was not ok. Failed to fetch {endpoint}")
+    return response.json()
+
+async def current_user_id(auth): # Spotify user ID, looked up once per session if /profile hasn't run
+    if 'user_id' not in auth.user:
+        auth.user['user_id'] = (await fetch_json(auth, 'me'))['id']
+        await asyncio.to_thread(update_session, auth.sid, {'user_id': auth.user['user_id']})
+    return auth.user['user_id']
+
+background_tasks = set() # the event loop only keeps weak references to tasks
+
+@traced
+async def current_taste(auth): # async counterpart of application.current_taste
+    user_id = await current_user_id(auth)
+    snapshot = await asyncio.to_thread(taste_snapshots.get, user_id)
+    if snapshot is None:
+        snapshot = await compute_taste(auth)
+        await asyncio.to_thread(taste_snapshots.put, user_id, snapshot)
+    elif taste_snapshots.is_stale(snapshot) and taste_snapshots.begin_refresh(user_id):
+        task = asyncio.create_task(refresh_taste(auth, user_id))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+    return snapshot
+
+async def refresh_taste(auth, user_id):
+    try:
+        await asyncio.to_thread(taste_snapshots.put, user_id, await compute_taste(auth))
+    except Exception as e:
+        log_error(f"Taste refresh for {user_id} failed. {str(e)}")
+    finally:
+        taste_snapshots.end_refresh(user_id)
+
+@traced
+async def compute_taste(auth): # top artists and tracks concurrently, then the tracks' audio features
+    top_artists, top_tracks = await asyncio.wait_for(
+        asyncio.gather(fetch_json(auth, 'me/top/artists'), fetch_json(auth, 'me/top/tracks')), PROFILE_CALL_DEADLINE,
+    )
+    track_ids = [track['id'] for track in top_tracks['items']]
+    avg_audio_features = await fetch_average_audio_features(auth, track_ids)
+    return taste_from_profile({'top_artists': top_artists, 'top_tracks': top_tracks}, avg_audio_features)
+
+@traced
+async def fetch_average_audio_features(auth, track_ids): # None when Spotify has no audio features to give
+    try:
+        audio_features = await fetch_json(auth, 'audio-features', params={'ids': ','.join(track_ids)})
+    except ValueError as e: # the endpoint is restricted for newer apps, recommendations are then ranked without it
+        log_error(str(e))
+        return None
+    return average_audio_features(audio_features.get('audio_features', []))
+
+@traced
+async def user_playlist_index(auth): # async counterpart of application.user_playlist_index
+    index_key = playlist_index_key(auth.user.get('user_id'), auth.sid)
+    cached = await asyncio.to_thread(playlist_index_cache.get, index_key)
+    if cached and cached['built_at'] + PLAYLIST_INDEX_REFRESH > time.time():
+        return cached['playlists']
+    playlists = [playlist async for playlist in paginate(auth, 'me/playlists', limit=50)]
+    index = index_playlists(playlists, cached['playlists'] if cached else None)
+    await asyncio.to_thread(playlist_index_cache.set, index_key, {'built_at': time.time(), 'playlists': index})
+    return index
+
+async def paginate(auth, endpoint, limit, params=None, max_items=None): # async counterpart of application.paginate
+    params = dict(params or {}, limit=limit)
+    first_page = await fetch_json(auth, endpoint, params={**params, 'offset': 0})
+    for item in first_page['items']:
+        yield item
+    total = first_page.get('total', 0) if max_items is None else min(first_page.get('total', 0), max_items)
+    offsets = iter(range(limit, total, limit))
+    fetch = lambda offset: asyncio.create_task(fetch_json(auth, endpoint, params={**params, 'offset': offset}))
+    window = deque(fetch(offset) for offset in islice(offsets, PAGINATION_MAX_WORKERS))
+    try:
+        while window:
+            page = await window.popleft()
+            offset = next(offsets, None)
+            if offset is not None:
+                window.append(fetch(offset))
+            for item in page['items']:
+                yield item
+    finally:
+        for task in window:
+            task.cancel()
+
+@traced
+async def build_seed_arrays(auth, matching_playlists, activity, taste):
+    seed_artists = []  # We want 2 total (1 from user, 1 from popular)
+    seed_genres = []   # We want 3 total (2 from user, 1 from popular)
+
+    # With a cold pool, draw a popular playlist while the user's own playlist is analyzed
+    seed_pool.ensure_fresh(activity)
+    popular_draw = None
+    if seed_pool.sample(activity, (), ()) is None:
+        popular_draw = asyncio.create_task(draw_popular_candidate(auth, activity))
+    try:
+        if matching_playlists:
+            top = await get_top_artist_and_genre(auth, *random.choice(matching_playlists))
+            seed_artists.append(top['artist'])
+            seed_genres.append(top['genre'])
+        else:
+            add_unique_item(seed_artists, taste['top_artists'])
+            add_unique_item(seed_genres, taste['top_genres'])
+
+        add_unique_item(seed_genres, taste['top_genres'])
+
+        # Select a unique popular artist and genre that aren't already in seeds
+        candidate = seed_pool.sample(activity, seed_artists, seed_genres)
+        for _ in range(0 if candidate else SEED_MAX_ATTEMPTS): # pool is cold or every candidate collides
+            try:
+                drawn = await (popular_draw or draw_popular_candidate(auth, activity))
+            except Exception as e: # a failed draw uses up its attempt, the user's own history is the fallback
+                log_error(f"Popular seed draw failed. {str(e)}")
+                continue
+            finally:
+                popular_draw = None
+            seed_pool.add(activity, drawn)
+            if drawn['artist'] not in seed_artists and drawn['genre'] not in seed_genres:
+                candidate = drawn
+                break
+    finally:
+        if popular_draw is not None:
+            popular_draw.cancel()
+
+    if candidate:
+        seed_artists.append(candidate['artist'])
+        seed_genres.append(candidate['genre'])
+    else: # fall back to the user's own listening history
+        add_unique_item(seed_artists, taste['top_artists'])
+        add_unique_item(seed_genres, taste['top_genres'])
+
+    if len(seed_artists) < 2 or len(seed_genres) < 3:
+        raise ValueError("Not enough unique artists and genres to seed recommendations")
+    return seed_artists, seed_genres
+
+@traced
+async def draw_popular_candidate(auth, activity):
+    search = await fetch_json(auth, 'search', params={'q': activity, 'type': 'playlist', 'limit': 20})
+    playlists = [playlist for playlist in search.get('playlists', {}).get('items', []) if playlist]
+    if not playlists:
+        raise ValueError("No playlists found for analysis")
+    playlist = random.choice(playlists)
+    top = await get_top_artist_and_genre(auth, playlist['id'], playlist.get('snapshot_id'))
+    return {'playlist_id': playlist['id'], **top}
+
+@traced
+async def get_top_artist_and_genre(auth, playlist_id, snapshot_id=None):
+    artist_ids = [artist_id for _, artist_id in await fetch_playlist_tracks(auth, playlist_id, snapshot_id)]
+    if not artist_ids:
+        raise ValueError("Could not find playlists to analyze")
+    return top_artist_and_genre(artist_ids, await fetch_artist_genres(auth, list(set(artist_ids))))
+
+@traced
+async def fetch_playlist_tracks(auth, playlist_id, snapshot_id=None): # async counterpart of application.fetch_playlist_tracks
+    cache_key = f"{playlist_id}:{snapshot_id or ''}"
+    pairs = await asyncio.to_thread(playlist_tracks_cache.get, cache_key)
+    if pairs is None:
+        tracks = paginate(auth, f"playlists/{playlist_id}/tracks", limit=100, params={'fields': PLAYLIST_TRACK_FIELDS}, max_items=PLAYLIST_TRACKS_LIMIT)
+        pairs = track_pairs([item.get('track') async for item in tracks if item])
+        if pairs:
+            await asyncio.to_thread(playlist_tracks_cache.set, cache_key, pairs)
+    return pairs
+
+@traced
+async def rank_recommendations(auth, seed_artists, seed_genres, matching_playlists, activity, taste, num_of_songs):
+    '''Async counterpart of application.rank_recommendations, every candidate source fetched concurrently.'''
+    features = taste['features']
+    playlists = random.sample(matching_playlists, min(len(matching_playlists), RANK_MAX_PLAYLISTS))
+    url = recommendations_url(seed_artists, seed_genres, num_of_songs, activity, features)
+    sources = await asyncio.gather(
+        fetch_json(auth, url),
+        *(fetch_json(auth, f"artists/{artist_id}/top-tracks", params={'market': 'from_token'}) for artist_id in seed_artists),
+        *(fetch_playlist_tracks(auth, *playlist) for playlist in playlists),
+        return_exceptions=True, # a failed candidate source shrinks the pool instead of failing the request
+    )
+    for source in sources:
+        if isinstance(source, Exception):
+            log_error(f"Candidate source failed. {str(source)}")
+    known_tracks = {}
+    for source in sources[:1 + len(seed_artists)]:
+        for track in ([] if isinstance(source, Exception) else source.get('tracks', [])):
+            known_tracks.setdefault(track['id'], track)
+    playlist_pairs = [pair for source in sources[1 + len(seed_artists):] if not isinstance(source, Exception) for pair in source]
+    pool = candidate_pool(track_pairs(known_tracks.values()), playlist_pairs)
+    ranked_ids = rank_pool(pool, await fetch_track_features(auth, [track_id for track_id, _ in pool]), activity, features, num_of_songs) if features else []
+    if not ranked_ids: # no audio features to rank with, keep the pool's order, Spotify's own picks first
+        ranked_ids = capped_pool_order(pool, num_of_songs)
+    return hydrated_batches(auth, ranked_ids, known_tracks)
+
+@traced
+async def fetch_track_features(auth, track_ids): # async counterpart of application.fetch_track_features
+    features_by_track = await asyncio.to_thread(audio_feature_cache.get_many, track_ids)
+    missing_ids = [track_id for track_id in track_ids if track_id not in features_by_track]
+    batches = [missing_ids[i:i+AUDIO_FEATURES_BATCH_SIZE] for i in range(0, len(missing_ids), AUDIO_FEATURES_BATCH_SIZE)]
+    results = await asyncio.gather(*(fetch_json(auth, 'audio-features', params={'ids': ','.join(batch_ids)}) for batch_ids in batches), return_exceptions=True)
+    fetched = {}
+    for batch_ids, result in zip(batches, results):
+        if isinstance(result, Exception): # failed batches aren't cached, the next request retries them
+            log_error(f"Candidate source failed. {str(result)}")
+            continue
+        fetched.update(zip(batch_ids, map(feature_vector, result.get('audio_features', []))))
+    await asyncio.to_thread(audio_feature_cache.set_many, fetched)
+    features_by_track.update(fetched)
+    return {track_id: vector for track_id, vector in features_by_track.items() if vector}
+
+async def hydrated_batches(auth, track_ids, known_tracks): # async counterpart of application.hydrated_batches
+    batches = [track_ids[i:i+TRACKS_BATCH_SIZE] for i in range(0, len(track_ids), TRACKS_BATCH_SIZE)]
+    tasks = [asyncio.ensure_future(fetch_tracks(auth, [track_id for track_id in batch if track_id not in known_tracks])) for batch in batches]
+    try:
+        for batch, task in zip(batches, tasks):
+            try:
+                fetched = await task
+            except Exception as e: # tracks of a failed batch are left out
+                log_error(f"Candidate source failed. {str(e)}")
+                fetched = {}
+            yield [track for track in (known_tracks.get(track_id) or fetched.get(track_id) for track_id in batch) if track]
+    finally: # the client went away mid-stream
+        for task in tasks:
+            task.cancel()
+
+@traced
+async def fetch_tracks(auth, track_ids): # async counterpart of application.fetch_tracks
+    if not track_ids:
+        return {}
+    result = await fetch_json(auth, 'tracks', params={'ids': ','.join(track_ids)})
+    return {track['id']: track for track in result.get('tracks', []) if track}
+
+@traced
+async def fetch_artist_genres(auth, artist_ids): # returns {artist_id: genres}, batches fetched concurrently
+    genres_by_artist = await asyncio.to_thread(artist_genre_cache.get_many, artist_ids)
+    missing_ids = [artist_id for artist_id in artist_ids if artist_id not in genres_by_artist]
+    batches = [missing_ids[i:i+ARTIST_BATCH_SIZE] for i in range(0, len(missing_ids), ARTIST_BATCH_SIZE)]
+    batch_results = await asyncio.gather(*(fetch_json(auth, 'artists', params={'ids': ','.join(batch_ids)}) for batch_ids in batches))
+    fetched = {
+        artist_info['id']: artist_info.get("genres", [])
+        for result in batch_results for artist_info in result.get("artists", []) if artist_info
+    }
+    await asyncio.to_thread(artist_genre_cache.set_many, fetched)
+    genres_by_artist.update(fetched)
+    return genres_by_artist
+
+
+def ndjson_response(request, batches, project): # async counterpart of application.ndjson_response
+    encoding = choose_encoding(request.headers.get('accept-encoding'))
+    compressor = StreamCompressor(encoding)
+    async def body():
+        async for batch in batches:
+            for chunk in ndjson_lines([batch], project):
+                yield compressor.compress(chunk)
+        yield compressor.finish()
+    headers = {'Vary': 'Accept-Encoding', **({'Content-Encoding': encoding} if encoding else {})}
+    return StreamingResponse(body(), media_type='application/x-ndjson', headers=headers)
+
+def compressed(endpoint): # gzip/brotli for buffered responses, as the Flask compress_response hook does
+    async def handle(request):
+        response = await endpoint(request)
+        body = getattr(response, 'body', None) # streamed responses have none and compress themselves
+        if not body or 'content-encoding' in response.headers or not compressible(response.media_type, len(body)):
+            return response
+        response.headers['Vary'] = 'Accept-Encoding'
+        encoding = choose_encoding(request.headers.get('accept-encoding'))
+        if encoding:
+            response.body = compress(body, encoding)
+            response.headers['Content-Length'] = str(len(response.body))
+            response.headers['Content-Encoding'] = encoding
+        return response
+    return handle
+
+def instrumented(route, endpoint): # request ID, route latency and trace, as the Flask hooks do for Flask routes
+    async def handle(request):
+        scope = begin_request(route, request.method, request.headers.get('X-Request-ID', '')[:64] or None, trace_requested(request.headers.get('X-Trace')))
+        try:
+            response = await endpoint(request)
+        except Exception as e:
+            end_request(scope, 500, str(e))
+            raise
+        response.headers['X-Request-ID'] = scope.request_id
+        if isinstance(response, StreamingResponse): # ended once the body is sent, so what it streams is measured and traced
+            response.body_iterator = scoped_stream(scope, response.status_code, response.body_iterator)
+        else:
+            end_request(scope, response.status_code)
+        return response
+    return handle
+
+async def scoped_stream(scope, status, chunks):
+    error = None
+    try:
+        async for chunk in chunks:
+            yield chunk
+    except Exception as e:
+        error = str(e)
+        raise
+    finally:
+        end_request(scope, 500 if error else status, error)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    await async_spotify.start()
+    yield
+    await async_spotify.close()
+
+app = Starlette(
+    routes=[
+        Route('/profile', instrumented('/profile', compressed(profile)), methods=['GET']),
+        Route('/recommendations', instrumented('/recommendations', compressed(recommendations)), methods=['POST', 'OPTIONS']),
+        Route('/build', instrumented('/build', compressed(build)), methods=['POST']),
+        Mount('/', WSGIMiddleware(application)), # everything else is the Flask app
+    ],
+    middleware=[
+        Middleware(
+            CORSMiddleware,
+            allow_origins=[frontend_test, frontend_origin, backend_origin],
+            allow_credentials=True,
+            allow_methods=['GET', 'POST', 'OPTIONS'],
+            allow_headers=['Content-Type', 'Authorization', SESSION_HEADER],
+        ),
+    ],
+    lifespan=lifespan,
+)
@@ -0,0 +1,508 @@
+'''Local stand-in for the Spotify Web API and accounts service, for benchmarks and offline runs.
+
+Serves every endpoint the backend calls (me, me/top/*, me/playlists, playlists/{id}/tracks,
+artists, artists/{id}/top-tracks, tracks, search, audio-features, recommendations, playlist creation
+and track insertion) plus the /api/token grants, with payloads shaped and sized like Spotify's:
+full track objects carry album images and ~180 market codes, paging objects honor limit/offset,
+and playlists/{id}/tracks honors `fields`. The catalog is generated deterministically from --seed.
+
+Every /v1 call can be delayed (--latency-ms, --jitter-ms) and fail with a 5xx (--error-rate)
+or a 429 with Retry-After (--rate-429), and --restricted audio-features,recommendations answers
+those endpoints with a 403 as Spotify does for newer apps. Call counts per endpoint are served on /_bench/stats,
+reset with POST /_bench/reset, and the fault settings can be read or changed on /_bench/config.
+
+    python bench/fake_spotify.py --port 5999 --latency-ms 40 --jitter-ms 20
+
+then start the backend against it:
+
+    API_BASE_URL=http://127.0.0.1:5999/v1/ TOKEN_URL=http://127.0.0.1:5999/api/token flask run
+'''
+import argparse
+import random
+import string
+import threading
+import time
+from collections import Counter
+
+from flask import Flask, jsonify, request
+
+GENRES = [
+    'pop', 'dance pop', 'edm', 'house', 'techno', 'hip hop', 'rap', 'trap', 'r&b', 'soul', 'funk', 'disco',
+    'rock', 'indie rock', 'alternative rock', 'classic rock', 'hard rock', 'metal', 'punk', 'emo', 'indie pop',
+    'folk', 'indie folk', 'singer-songwriter', 'country', 'americana', 'blues', 'jazz', 'smooth jazz', 'bossa nova',
+    'classical', 'ambient', 'lo-fi beats', 'chillhop', 'downtempo', 'trip hop', 'drum and bass', 'dubstep',
+    'reggae', 'reggaeton', 'latin pop', 'k-pop', 'j-pop', 'afrobeats', 'gospel', 'new age', 'synthwave', 'acoustic',
+]
+MARKETS = [a + b for a in 'ABCDEFGHIJKLMNOPRSTUVZ' for b in 'AEGKLMORTUY'][:183] # as many codes as Spotify lists
+ACTIVITY_WORDS = ['workout', 'gym', 'chill', 'meditation', 'road trip', 'party', 'focus', 'study', 'cooking', 'cleaning', 'date night', 'romantic']
+FILLER_WORDS = ['vibes', 'mix', 'favorites', 'summer', 'late night', 'throwbacks', 'mood', 'essentials', 'on repeat', 'discoveries']
+BASE62 = string.digits + string.ascii_letters
+
+config = {
+    'seed': 1,
+    'latency_ms': 30.0,
+    'jitter_ms': 10.0,
+    'error_rate': 0.0,
+    'rate_429': 0.0,
+    'retry_after': 1,
+    'artists': 5000,
+    'tracks_per_artist': 50,
+    'user_playlists': 60,
+    'token_expires_in': 3600,
+    'restricted': '', # comma-separated /v1 paths answered with a 403
+}
+
+application = Flask(__name__)
+stats_lock = threading.Lock()
+stats = {'calls': Counter(), 'status': Counter(), 'bytes': Counter()}
+created_playlists = {} # playlist_id -> URIs added through the API
+
+
+# CATALOG
+
+
+def spotify_id(n): # 22-character base62 ID that decodes back to n
+    digits = []
+    while n:
+        n, rem = divmod(n, 62)
+        digits.append(BASE62[rem])
+    return ''.join(reversed(digits)).rjust(22, '0')
+
+def id_number(value):
+    n = 0
+    for char in value:
+        n = n * 62 + BASE62.index(char)
+    return n
+
+def rng(*parts):
+    return random.Random(':'.join(str(part) for part in (config['seed'], *parts)))
+
+def image_set(kind, item_id):
+    return [
+        {'url': f"https://i.scdn.co/image/{kind}{size}{item_id}", 'height': size, 'width': size}
+        for size in (640, 300, 64)
+    ]
+
+def simplified_artist(artist):
+    artist_id = spotify_id(artist)
+    return {
+        'external_urls': {'spotify': f"https://open.spotify.com/artist/{artist_id}"},
+        'href': f"https://api.spotify.com/v1/artists/{artist_id}",
+        'id': artist_id,
+        'name': f"Artist {artist}",
+        'type': 'artist',
+        'uri': f"spotify:artist:{artist_id}",
+    }
+
+def full_artist(artist):
+    r = rng('artist', artist)
+    artist_id = spotify_id(artist)
+    return {
+        **simplified_artist(artist),
+        'followers': {'href': None, 'total': r.randint(100, 5_000_000)},
+        'genres': r.sample(GENRES, r.randint(0, 4)), # some artists have no genres, as on Spotify
+        'images': image_set('ab6761610000e5eb', artist_id),
+        'popularity': r.randint(5, 95),
+    }
+
+def track_artist(track):
+    return track // config['tracks_per_artist']
+
+def full_track(track):
+    r = rng('track', track)
+    track_id = spotify_id(track)
+    artists = [track_artist(track)] + ([r.randrange(config['artists'])] if r.random() < 0.2 else [])
+    album_id = spotify_id(track // 10 + 1_000_000)
+    return {
+        'album': {
+            'album_type': 'album',
+            'artists': [simplified_artist(artists[0])],
+            'available_markets': MARKETS,
+            'external_urls': {'spotify': f"https://open.spotify.com/album/{album_id}"},
+            'href': f"https://api.spotify.com/v1/albums/{album_id}",
+            'id': album_id,
+            'images': image_set('ab67616d0000b273', album_id),
+            'name': f"Album {track // 10}",
+            'release_date': f"{r.randint(1970, 2024)}-{r.randint(1, 12):02d}-{r.randint(1, 28):02d}",
+            'release_date_precision': 'day',
+            'total_tracks': 10,
+            'type': 'album',
+            'uri': f"spotify:album:{album_id}",
+        },
+        'artists': [simplified_artist(artist) for artist in artists],
+        'available_markets': MARKETS,
+        'disc_number': 1,
+        'duration_ms': r.randint(120_000, 360_000),
+        'explicit': r.random() < 0.2,
+        'external_ids': {'isrc': f"US{track:010d}"},
+        'external_urls': {'spotify': f"https://open.spotify.com/track/{track_id}"},
+        'href': f"https://api.spotify.com/v1/tracks/{track_id}",
+        'id': track_id,
+        'is_local': False,
+        'name': f"Track {track}",
+        'popularity': r.randint(0, 100),
+        'preview_url': f"https://p.scdn.co/mp3-preview/{track_id}" if r.random() < 0.7 else None,
+        'track_number': track % 10 + 1,
+        'type': 'track',
+        'uri': f"spotify:track:{track_id}",
+    }
+
+def audio_features(track):
+    r = rng('features', track)
+    track_id = spotify_id(track)
+    return {
+        'acousticness': round(r.random(), 3),
+        'analysis_url': f"https://api.spotify.com/v1/audio-analysis/{track_id}",
+        'danceability': round(r.uniform(0.2, 0.95), 3),
+        'duration_ms': r.randint(120_000, 360_000),
+        'energy': round(r.uniform(0.1, 0.98), 3),
+        'id': track_id,
+        'instrumentalness': round(r.random() ** 3, 3),
+        'key': r.randint(0, 11),
+        'liveness': round(r.uniform(0.05, 0.6), 3),
+        'loudness': round(r.uniform(-20, -3), 3),
+        'mode': r.randint(0, 1),
+        'speechiness': round(r.uniform(0.02, 0.4), 3),
+        'tempo': round(r.uniform(60, 180), 3),
+        'time_signature': 4,
+        'track_href': f"https://api.spotify.com/v1/tracks/{track_id}",
+        'type': 'audio_features',
+        'uri': f"spotify:track:{track_id}",
+        'valence': round(r.random(), 3),
+    }
+
+def random_track(r, artists):
+    return r.choice(artists) * config['tracks_per_artist'] + r.randrange(config['tracks_per_artist'])
+
+def playlist_meta(key):
+    '''(name, total tracks, dominant artists) of a user (`u:<user>:<n>`) or popular (`p:<query>:<n>`) playlist.'''
+    r = rng('playlist', key)
+    kind, subject = key.split(':', 1)
+    subject = subject.rsplit(':', 1)[0]
+    if kind == 'p':
+        name = f"{subject.title()} {r.choice(FILLER_WORDS).title()}"
+    elif r.random() < 0.3:
+        name = f"{r.choice(ACTIVITY_WORDS).title()} {r.choice(FILLER_WORDS)}"
+    else:
+        name = f"{r.choice(FILLER_WORDS).title()} {r.randint(1, 99)}"
+    artists = [r.randrange(config['artists']) for _ in range(r.randint(5, 25))]
+    return name, r.randint(20, 400), artists
+
+def playlist_id(key): # encodes the key, so IDs stay valid across restarts of the fake
+    return 'pl' + key.encode().hex()
+
+def playlist_key(pid): # None for IDs this fake didn't hand out
+    try:
+        key = bytes.fromhex(pid[2:]).decode() if pid.startswith('pl') else ''
+    except ValueError:
+        return None
+    return key if key[:2] in ('u:', 'p:') and key.count(':') >= 2 else None
+
+def playlist_object(key, owner):
+    name, total, _ = playlist_meta(key)
+    pid = playlist_id(key)
+    return {
+        'collaborative': False,
+        'description': '',
+        'external_urls': {'spotify': f"https://open.spotify.com/playlist/{pid}"},
+        'href': f"https://api.spotify.com/v1/playlists/{pid}",
+        'id': pid,
+        'images': image_set('ab67706c0000da84', pid),
+        'name': name,
+        'owner': {'display_name': owner, 'id': owner, 'type': 'user', 'uri': f"spotify:user:{owner}"},
+        'public': True,
+        'snapshot_id': f"snap{config['seed']}{total}",
+        'tracks': {'href': f"https://api.spotify.com/v1/playlists/{pid}/tracks", 'total': total},
+        'type': 'playlist',
+        'uri': f"spotify:playlist:{pid}",
+    }
+
+def page(items, total, limit, offset, href):
+    return {
+        'href': href,
+        'items': items,
+        'limit': limit,
+        'next': f"{href}?offset={offset + limit}&limit={limit}" if offset + limit < total else None,
+        'offset': offset,
+        'previous': f"{href}?offset={max(offset - limit, 0)}&limit={limit}" if offset else None,
+        'total': total,
+    }
+
+def paging_args(max_limit, default=20):
+    limit = min(int(request.args.get('limit', default)), max_limit)
+    return limit, int(request.args.get('offset', 0))
+
+def parse_fields(fields): # Spotify's `fields` syntax, e.g. items(track(artists(id))),total -> nested dict
+    tree, stack, name = {}, [], ''
+    for char in fields + ',':
+        if char in ',()':
+            if name:
+                tree[name] = {}
+            if char == '(':
+                stack.append(tree)
+                tree = tree[name]
+            elif char == ')':
+                tree = stack.pop()
+            name = ''
+        else:
+            name += char
+    return tree
+
+def project(value, tree):
+    if not tree:
+        return value
+    if isinstance(value, list):
+        return [project(item, tree) for item in value]
+    if isinstance(value, dict):
+        return {key: project(value[key], sub) for key, sub in tree.items() if key in value}
+    return value
+
+
+# AUTH
+
+
+def token_user(): # the user an access token was issued to, None for app tokens
+    token = request.headers.get('Authorization', '').removeprefix('Bearer ')
+    if not token.startswith('fake-'):
+        return None
+    user = token.split('-', 2)[1]
+    return None if user == 'app' else user
+
+@application.route('/api/token', methods=['POST'])
+def token():
+    grant = request.form.get('grant_type')
+    if grant == 'authorization_code':
+        user = ''.join(char for char in request.form.get('code', 'user') if char.isalnum()) or 'user'
+        body = {'refresh_token': f"refresh-{user}"}
+    elif grant == 'refresh_token':
+        user = request.form.get('refresh_token', 'refresh-user').split('-', 1)[1]
+        body = {}
+    elif grant == 'client_credentials':
+        user = 'app'
+        body = {}
+    else:
+        return jsonify({'error': 'unsupported_grant_type'}), 400
+    return jsonify({
+        'access_token': f"fake-{user}-{int(time.time() * 1000)}",
+        'token_type': 'Bearer',
+        'expires_in': config['token_expires_in'],
+        **body,
+    })
+
+
+# API
+
+
+@application.before_request
+def inject_faults():
+    if not request.path.startswith('/v1/'):
+        return None
+    if not request.headers.get('Authorization', '').startswith('Bearer fake-'):
+        return jsonify({'error': {'status': 401, 'message': 'Invalid access token'}}), 401
+    if request.path[len('/v1/'):] in filter(None, config['restricted'].split(',')):
+        return jsonify({'error': {'status': 403, 'message': 'Forbidden'}}), 403
+    delay = config['latency_ms'] + random.uniform(-config['jitter_ms'], config['jitter_ms'])
+    time.sleep(max(delay, 0) / 1000)
+    roll = random.random()
+    if roll < config['rate_429']:
+        response = jsonify({'error': {'status': 429, 'message': 'API rate limit exceeded'}})
+        response.headers['Retry-After'] = str(config['retry_after'])
+        return response, 429
+    if roll < config['rate_429'] + config['error_rate']:
+        return jsonify({'error': {'status': 503, 'message': 'Service unavailable'}}), 503
+    return None
+
+@application.after_request
+def count_call(response):
+    if request.path.startswith('/v1/'):
+        endpoint = f"{request.method} {request.url_rule.rule if request.url_rule else request.path}"
+        with stats_lock:
+            stats['calls'][endpoint] += 1
+            stats['status'][str(response.status_code)] += 1
+            stats['bytes'][endpoint] += response.calculate_content_length() or 0
+    return response
+
+@application.route('/v1/me')
+def me():
+    user = token_user() or 'app'
+    return jsonify({
+        'country': 'US',
+        'display_name': f"Bench {user}",
+        'email': f"{user}@example.com",
+        'explicit_content': {'filter_enabled': False, 'filter_locked': False},
+        'external_urls': {'spotify': f"https://open.spotify.com/user/{user}"},
+        'followers': {'href': None, 'total': 3},
+        'href': f"https://api.spotify.com/v1/users/{user}",
+        'id': user,
+        'images': image_set('ab6775700000ee85', user)[:2],
+        'product': 'premium',
+        'type': 'user',
+        'uri': f"spotify:user:{user}",
+    })
+
+def user_top_artists(user):
+    r = rng('top', user)
+    return [r.randrange(config['artists']) for _ in range(50)]
+
+@application.route('/v1/me/top/artists')
+def top_artists():
+    limit, offset = paging_args(50)
+    artists = user_top_artists(token_user())
+    return jsonify(page([full_artist(artist) for artist in artists[offset:offset + limit]], len(artists), limit, offset, 'https://api.spotify.com/v1/me/top/artists'))
+
+@application.route('/v1/me/top/tracks')
+def top_tracks():
+    limit, offset = paging_args(50)
+    r = rng('top-tracks', token_user())
+    tracks = [random_track(r, user_top_artists(token_user())) for _ in range(50)]
+    return jsonify(page([full_track(track) for track in tracks[offset:offset + limit]], len(tracks), limit, offset, 'https://api.spotify.com/v1/me/top/tracks'))
+
+@application.route('/v1/me/playlists')
+def my_playlists():
+    limit, offset = paging_args(50)
+    user = token_user() or 'app'
+    total = config['user_playlists']
+    items = [playlist_object(f"u:{user}:{n}", user) for n in range(offset, min(offset + limit, total))]
+    return jsonify(page(items, total, limit, offset, 'https://api.spotify.com/v1/me/playlists'))
+
+@application.route('/v1/playlists/<pid>/tracks', methods=['GET'])
+def playlist_tracks(pid):
+    limit, offset = paging_args(100, default=100)
+    if pid in created_playlists:
+        tracks = [id_number(uri.rsplit(':', 1)[1]) for uri in created_playlists[pid] if uri.startswith('spotify:track:')]
+    elif playlist_key(pid):
+        _, total, artists = playlist_meta(playlist_key(pid))
+        r = rng('playlist-tracks', pid)
+        tracks = [random_track(r, artists) for _ in range(total)]
+    else:
+        return jsonify({'error': {'status': 404, 'message': 'Not found.'}}), 404
+    items = [
+        {'added_at': '2024-01-01T00:00:00Z', 'added_by': None, 'is_local': False, 'track': full_track(track)}
+        for track in tracks[offset:offset + limit]
+    ]
+    body = page(items, len(tracks), limit, offset, f"https://api.spotify.com/v1/playlists/{pid}/tracks")
+    if request.args.get('fields'):
+        body = project(body, parse_fields(request.args['fields']))
+    return jsonify(body)
+
+@application.route('/v1/playlists/<pid>/tracks', methods=['POST'])
+def add_tracks(pid):
+    body = request.get_json(silent=True) or {}
+    uris = body.get('uris', [])
+    if not uris or len(uris) > 100:
+        return jsonify({'error': {'status': 400, 'message': 'Invalid number of URIs'}}), 400
+    tracks = created_playlists.setdefault(pid, [])
+    position = body.get('position', len(tracks))
+    if position > len(tracks):
+        return jsonify({'error': {'status': 400, 'message': 'Invalid position'}}), 400
+    tracks[position:position] = uris
+    return jsonify({'snapshot_id': f"snap{len(tracks)}"}), 201
+
+@application.route('/v1/users/<user_id>/playlists', methods=['POST'])
+def create_playlist(user_id):
+    body = request.get_json(silent=True) or {}
+    pid = 'new' + ''.join(random.choice(BASE62) for _ in range(19))
+    created_playlists[pid] = []
+    playlist = playlist_object(f"u:{user_id}:new", user_id)
+    playlist.update(id=pid, name=body.get('name', 'New Playlist'), public=body.get('public', True), tracks={'href': None, 'total': 0})
+    return jsonify(playlist), 201
+
+@application.route('/v1/artists')
+def artists():
+    ids = [artist_id for artist_id in request.args.get('ids', '').split(',') if artist_id]
+    if len(ids) > 50:
+        return jsonify({'error': {'status': 400, 'message': 'Too many ids requested'}}), 400
+    return jsonify({'artists': [
+        full_artist(id_number(artist_id)) if id_number(artist_id) < config['artists'] else None for artist_id in ids
+    ]})
+
+@application.route('/v1/artists/<artist_id>/top-tracks')
+def artist_top_tracks(artist_id):
+    artist = id_number(artist_id)
+    r = rng('artist-top', artist)
+    tracks = r.sample(range(config['tracks_per_artist']), 10)
+    return jsonify({'tracks': [full_track(artist * config['tracks_per_artist'] + track) for track in tracks]})
+
+@application.route('/v1/tracks')
+def tracks():
+    ids = [track_id for track_id in request.args.get('ids', '').split(',') if track_id]
+    if len(ids) > 50:
+        return jsonify({'error': {'status': 400, 'message': 'Too many ids requested'}}), 400
+    return jsonify({'tracks': [full_track(id_number(track_id)) for track_id in ids]})
+
+@application.route('/v1/search')
+def search():
+    limit, offset = paging_args(50)
+    query = request.args.get('q', '').lower()
+    items = [playlist_object(f"p:{query}:{n}", 'spotify') for n in range(offset, offset + limit)]
+    if items and rng('search', query).random() < 0.3: # Spotify pads search results with nulls
+        items[-1] = None
+    return jsonify({'playlists': page(items, 1000, limit, offset, 'https://api.spotify.com/v1/search')})
+
+@application.route('/v1/audio-features')
+def features():
+    ids = [track_id for track_id in request.args.get('ids', '').split(',') if track_id]
+    if len(ids) > 100:
+        return jsonify({'error': {'status': 400, 'message': 'Too many ids requested'}}), 400
+    return jsonify({'audio_features': [audio_features(id_number(track_id)) for track_id in ids]})
+
+@application.route('/v1/recommendations')
+def recommendations():
+    limit = min(int(request.args.get('limit', 20)), 100)
+    seed_artists = [artist_id for artist_id in request.args.get('seed_artists', '').split(',') if artist_id]
+    seed_genres = [genre for genre in request.args.get('seed_genres', '').split(',') if genre]
+    if not 1 <= len(seed_artists) + len(seed_genres) <= 5:
+        return jsonify({'error': {'status': 400, 'message': 'Invalid seeds'}}), 400
+    r = random.Random(request.query_string)
+    artists = [id_number(artist_id) for artist_id in seed_artists] + [r.randrange(config['artists']) for _ in range(20)]
+    seeds = [
+        {'afterFilteringSize': 250, 'afterRelinkingSize': 250, 'href': None, 'id': seed, 'initialPoolSize': 500, 'type': kind}
+        for kind, values in (('ARTIST', seed_artists), ('GENRE', seed_genres)) for seed in values
+    ]
+    return jsonify({'seeds': seeds, 'tracks': [full_track(random_track(r, artists)) for _ in range(limit)]})
+
+
+# BENCH CONTROL
+
+
+@application.route('/_bench/stats')
+def bench_stats():
+    with stats_lock:
+        return jsonify({
+            'calls': sum(stats['calls'].values()),
+            'by_endpoint': dict(stats['calls']),
+            'bytes': dict(stats['bytes']),
+            'status': dict(stats['status']),
+        })
+
+@application.route('/_bench/reset', methods=['POST'])
+def bench_reset():
+    with stats_lock:
+        for counter in stats.values():
+            counter.clear()
+    return jsonify({'reset': True})
+
+@application.route('/_bench/config', methods=['GET', 'POST'])
+def bench_config():
+    if request.method == 'POST':
+        updates = request.get_json(silent=True) or {}
+        unknown = set(updates) - set(config)
+        if unknown:
+            return jsonify({'error': f"Unknown settings: {', '.join(sorted(unknown))}"}), 400
+        config.update({key: type(config[key])(value) for key, value in updates.items()})
+    return jsonify(config)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', 1)[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5999)
+    for key, value in config.items():
+        parser.add_argument(f"--{key.replace('_', '-')}", type=type(value), default=value)
+    args = parser.parse_args()
+    config.update({key: getattr(args, key) for key in config})
+    application.run(host=args.host, port=args.port, threaded=True)
+
+
+if __name__ == '__main__':
+    main()
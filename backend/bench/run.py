@@ -0,0 +1,177 @@
+'''Load benchmark for /profile, /recommendations and /build against bench/fake_spotify.py.
+
+Logs in --users virtual users through /callback (the fake accepts any code), then drives each
+route at every --concurrency level for --requests requests and reports throughput, p50/p95/p99
+latency, errors and the outbound Spotify calls per request counted by the fake. Results are
+written as JSON, and two result files can be compared to spot regressions between commits.
+
+    python bench/fake_spotify.py --latency-ms 40 --jitter-ms 20 &
+    API_BASE_URL=http://127.0.0.1:5999/v1/ TOKEN_URL=http://127.0.0.1:5999/api/token SECRET_KEY=bench flask run --port 5000 &
+    python bench/run.py --concurrency 1 10 50 --requests 200 --label sync
+    python bench/run.py compare bench/results/old.json bench/results/new.json
+
+Run with the deployment's limiter settings. SPOTIFY_RATE_LIMIT/SPOTIFY_TOKEN_RATE_LIMIT pace
+calls only when set, and the fake's --rate-429 exercises the Retry-After path. Use SERVER_MODE's
+uvicorn command instead of `flask run` for the async mode.
+'''
+import argparse
+import json
+import math
+import os
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+ROUTES = ('profile', 'recommendations', 'build')
+ACTIVITIES = ('workout', 'relaxation', 'road_trip', 'party', 'focus', 'cooking', 'cleaning', 'date_night')
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+def login(backend, n): # a requests.Session carrying the user's signed session ID
+    user = requests.Session()
+    response = user.get(f"{backend}/callback", params={'code': f"bench{n}"}, allow_redirects=False)
+    _, _, fragment = response.headers.get('Location', '').partition('#session=')
+    if response.status_code != 302 or not fragment:
+        raise RuntimeError(f"Login failed for bench{n}: {response.status_code} {response.text[:200]}")
+    user.headers['X-Session'] = fragment # as the frontend does, the Secure cookie doesn't travel over plain HTTP
+    return user
+
+def call(backend, route, user, i, fields=None): # returns (seconds, status code, response bytes on the wire)
+    start = time.perf_counter()
+    try:
+        if route == 'profile':
+            response = user.get(f"{backend}/profile", allow_redirects=False)
+        elif route == 'recommendations':
+            response = user.post(f"{backend}/recommendations", json={'activity': ACTIVITIES[i % len(ACTIVITIES)], **({'fields': fields} if fields else {})})
+        else:
+            songs = [f"spotify:track:{n:022d}" for n in range(i, i + 100)]
+            response = user.post(f"{backend}/build", json={'name': f"Bench {i}", 'songs': songs})
+        return time.perf_counter() - start, response.status_code, int(response.headers.get('Content-Length', len(response.content)))
+    except requests.RequestException:
+        return time.perf_counter() - start, 0, 0
+
+def percentile(sorted_values, pct): # nearest rank
+    if not sorted_values:
+        return None
+    return sorted_values[max(math.ceil(pct / 100 * len(sorted_values)) - 1, 0)]
+
+def fake_stats(fake):
+    return requests.get(f"{fake}/_bench/stats").json()
+
+def run_level(backend, fake, route, users, concurrency, total, fields=None):
+    requests.post(f"{fake}/_bench/reset")
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(lambda i: call(backend, route, users[i % len(users)], i, fields), range(total)))
+    elapsed = time.perf_counter() - start
+    outbound = fake_stats(fake)
+    latencies = sorted(seconds * 1000 for seconds, status, _ in results)
+    errors = sum(1 for _, status, _ in results if not 200 <= status < 300)
+    return {
+        'route': route,
+        'concurrency': concurrency,
+        'requests': total,
+        'errors': errors,
+        'seconds': round(elapsed, 3),
+        'throughput_rps': round(total / elapsed, 2),
+        'latency_ms': {
+            'p50': round(percentile(latencies, 50), 2),
+            'p95': round(percentile(latencies, 95), 2),
+            'p99': round(percentile(latencies, 99), 2),
+            'max': round(latencies[-1], 2),
+            'mean': round(sum(latencies) / len(latencies), 2),
+        },
+        'response_bytes': round(sum(size for _, _, size in results) / total),
+        'outbound_calls_per_request': round(outbound['calls'] / total, 2),
+        'outbound_by_endpoint': {endpoint: round(calls / total, 2) for endpoint, calls in sorted(outbound['by_endpoint'].items())},
+        'outbound_status': outbound['status'],
+    }
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def print_row(result):
+    latency = result['latency_ms']
+    print(
+        f"{result['route']:<16}c={result['concurrency']:<4}{result['throughput_rps']:>8} rps"
+        f"  p50 {latency['p50']:>8}  p95 {latency['p95']:>8}  p99 {latency['p99']:>8} ms"
+        f"  {result['outbound_calls_per_request']:>6} calls/req  {result['errors']} errors"
+    )
+
+def run(args):
+    print(f"Logging in {args.users} users")
+    users = [login(args.backend, n) for n in range(args.users)]
+    if 'profile' not in args.routes: # recommendations and build still need a taste snapshot and user ID
+        for user in users:
+            user.get(f"{args.backend}/profile")
+    report = {
+        'label': args.label,
+        'commit': git_commit(),
+        'started_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'backend': args.backend,
+        'users': args.users,
+        'fields': args.fields,
+        'fake_config': requests.get(f"{args.fake}/_bench/config").json(),
+        'results': [],
+    }
+    for route in args.routes:
+        for concurrency in args.concurrency:
+            result = run_level(args.backend, args.fake, route, users, concurrency, args.requests, args.fields)
+            report['results'].append(result)
+            print_row(result)
+
+    out = args.out or os.path.join(RESULTS_DIR, f"{report['commit'] or 'nocommit'}-{args.label}-{int(time.time())}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Saved {out}")
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    before = {(result['route'], result['concurrency']): result for result in baseline['results']}
+    print(f"{baseline.get('commit')} ({baseline.get('label')}) -> {candidate.get('commit')} ({candidate.get('label')})")
+    for result in candidate['results']:
+        old = before.get((result['route'], result['concurrency']))
+        if old is None:
+            continue
+        change = lambda new, prev: f"{(new - prev) / prev * 100:+.1f}%" if prev else 'n/a'
+        print(
+            f"{result['route']:<16}c={result['concurrency']:<4}"
+            f"rps {change(result['throughput_rps'], old['throughput_rps']):>8}"
+            f"  p50 {change(result['latency_ms']['p50'], old['latency_ms']['p50']):>8}"
+            f"  p95 {change(result['latency_ms']['p95'], old['latency_ms']['p95']):>8}"
+            f"  p99 {change(result['latency_ms']['p99'], old['latency_ms']['p99']):>8}"
+            f"  calls/req {old['outbound_calls_per_request']} -> {result['outbound_calls_per_request']}"
+        )
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if argv[:1] == ['compare']:
+        parser = argparse.ArgumentParser(prog='run.py compare', description='Compare two benchmark result files.')
+        parser.add_argument('baseline')
+        parser.add_argument('candidate')
+        return compare(parser.parse_args(argv[1:]))
+    parser = argparse.ArgumentParser(description=__doc__.split('\n', 1)[0])
+    parser.add_argument('--backend', default='http://127.0.0.1:5000')
+    parser.add_argument('--fake', default='http://127.0.0.1:5999')
+    parser.add_argument('--routes', nargs='+', choices=ROUTES, default=list(ROUTES))
+    parser.add_argument('--concurrency', nargs='+', type=int, default=[1, 10, 50])
+    parser.add_argument('--requests', type=int, default=100, help='requests per route and concurrency level')
+    parser.add_argument('--users', type=int, default=50, help='virtual users the requests rotate through')
+    parser.add_argument('--fields', choices=['compact'], help='track projection requested from /recommendations')
+    parser.add_argument('--label', default='run', help='free-form tag stored with the results, e.g. sync or async')
+    parser.add_argument('--out', help='result file, defaults to bench/results/<commit>-<label>-<time>.json')
+    return run(parser.parse_args(argv))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,209 @@
+import copy
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+# Process-wide caches for slow-changing Spotify data (artist genres, playlist track listings) and user sessions.
+# TTLCache keeps entries in memory per worker, SQLiteCache persists them to a local file so they
+# survive restarts and can be shared by every worker process on the same host.
+
+
+class TTLCache:
+    '''In-memory LRU cache with per-entry expiry, bounded by max_entries.
+
+    Values are copied in and out (one level deep), so like SQLiteCache's every caller gets its own
+    dict or list and changing it doesn't change the stored entry under other requests.
+    '''
+
+    def __init__(self, name, max_entries=1024, ttl=300):
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict() # key -> (expires_at, value), oldest access first
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None or entry[0] < time.time():
+                if entry is not None:
+                    del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+        return copy.copy(entry[1])
+
+    def get_many(self, keys): # returns {key: value} for the keys that are cached
+        found = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                found[key] = value
+        return found
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.time() + (ttl if ttl is not None else self.ttl)
+        value = copy.copy(value)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def set_many(self, mapping, ttl=None):
+        for key, value in mapping.items():
+            self.set(key, value, ttl)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            'backend': 'memory',
+            'entries': len(self),
+            'max_entries': self.max_entries,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+SQLITE_BATCH_SIZE = 500 # keys per IN (...) query, under SQLite's bound-parameter limit
+ACCESS_RESOLUTION = 60 # seconds, accessed_at is only rewritten once it's older than this
+
+
+class SQLiteCache(TTLCache):
+    '''Same interface as TTLCache, stored in a SQLite table that several processes can share.
+
+    Values must be JSON serializable. Hit/miss/eviction counters are per process. Reads only
+    write back accessed_at (for LRU eviction) when it's older than ACCESS_RESOLUTION, so hot keys
+    don't turn every lookup into a write transaction.
+    '''
+
+    def __init__(self, name, path, max_entries=1024, ttl=300):
+        super().__init__(name, max_entries, ttl)
+        self.path = path
+        self._local = threading.local() # sqlite connections can't be shared across threads
+        self._writes = 0
+        with self._connect() as conn:
+            conn.execute(
+                f'CREATE TABLE IF NOT EXISTS "{self.name}" '
+                '(key TEXT PRIMARY KEY, value TEXT NOT NULL, expires_at REAL NOT NULL, accessed_at REAL NOT NULL)'
+            )
+            conn.execute(f'CREATE INDEX IF NOT EXISTS "{self.name}_accessed" ON "{self.name}" (accessed_at)')
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            conn.execute('PRAGMA journal_mode=WAL') # readers don't block the writer across workers
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def get(self, key, default=None):
+        value = self.get_many([key]).get(key)
+        return default if value is None else value
+
+    def get_many(self, keys): # one SELECT per SQLITE_BATCH_SIZE keys, one transaction for the accessed_at updates
+        now = time.time()
+        keys = list(dict.fromkeys(keys))
+        conn = self._connect()
+        found = {}
+        touched = []
+        for i in range(0, len(keys), SQLITE_BATCH_SIZE):
+            batch = keys[i:i+SQLITE_BATCH_SIZE]
+            rows = conn.execute(
+                f'SELECT key, value, expires_at, accessed_at FROM "{self.name}" WHERE key IN ({",".join("?" * len(batch))})',
+                batch,
+            ).fetchall()
+            for key, value, expires_at, accessed_at in rows:
+                if expires_at < now:
+                    continue
+                found[key] = json.loads(value)
+                if now - accessed_at > ACCESS_RESOLUTION:
+                    touched.append((now, key))
+        if touched:
+            with conn:
+                conn.executemany(f'UPDATE "{self.name}" SET accessed_at = ? WHERE key = ?', touched)
+        found = {key: value for key, value in found.items() if value is not None}
+        with self._lock:
+            self.hits += len(found)
+            self.misses += len(keys) - len(found)
+        return found
+
+    def set(self, key, value, ttl=None):
+        self.set_many({key: value}, ttl)
+
+    def set_many(self, mapping, ttl=None): # a single transaction for the whole mapping
+        if not mapping:
+            return
+        now = time.time()
+        expires_at = now + (ttl if ttl is not None else self.ttl)
+        conn = self._connect()
+        with conn:
+            conn.executemany(
+                f'INSERT OR REPLACE INTO "{self.name}" (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)',
+                [(key, json.dumps(value), expires_at, now) for key, value in mapping.items()],
+            )
+        writes_before = self._writes
+        self._writes += len(mapping)
+        if self._writes // 100 != writes_before // 100: # amortize the size check instead of counting rows on every write
+            self._evict()
+
+    def _evict(self):
+        conn = self._connect()
+        with conn:
+            expired = conn.execute(f'DELETE FROM "{self.name}" WHERE expires_at < ?', (time.time(),)).rowcount
+            overflow = conn.execute(f'SELECT COUNT(*) FROM "{self.name}"').fetchone()[0] - self.max_entries
+            if overflow > 0:
+                conn.execute(
+                    f'DELETE FROM "{self.name}" WHERE key IN '
+                    f'(SELECT key FROM "{self.name}" ORDER BY accessed_at LIMIT ?)',
+                    (overflow,),
+                )
+        with self._lock:
+            self.evictions += expired + max(overflow, 0)
+
+    def delete(self, key):
+        conn = self._connect()
+        with conn:
+            conn.execute(f'DELETE FROM "{self.name}" WHERE key = ?', (key,))
+
+    def clear(self):
+        conn = self._connect()
+        with conn:
+            conn.execute(f'DELETE FROM "{self.name}"')
+
+    def __len__(self):
+        return self._connect().execute(f'SELECT COUNT(*) FROM "{self.name}"').fetchone()[0]
+
+    def stats(self):
+        stats = super().stats()
+        stats['backend'] = 'sqlite'
+        return stats
+
+
+def make_cache(name, max_entries, ttl, backend=None):
+    '''Returns a cache for the given backend ("memory" or "sqlite"), defaulting to CACHE_BACKEND.'''
+    if (backend or os.getenv('CACHE_BACKEND', 'memory')) == 'sqlite':
+        return SQLiteCache(name, os.getenv('CACHE_PATH', 'cache.sqlite3'), max_entries, ttl)
+    return TTLCache(name, max_entries, ttl)
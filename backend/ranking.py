@@ -0,0 +1,67 @@
+import numpy as np
+
+# Local ranking of candidate tracks against an activity's audio-feature constraints.
+# Candidates are scored in one vectorized pass over an (n_tracks, n_features) float32 array, then
+# picked best-first under a per-artist cap so a single artist can't fill the playlist.
+
+FEATURE_SCALES = {'tempo': 250.0} # BPM, every other feature is already 0..1
+
+VIOLATION_WEIGHT = 4.0 # per unit a min_/max_ bound is missed by
+TARGET_WEIGHT = 1.0 # per unit of distance from a target_ value
+AFFINITY_WEIGHT = 0.5 # mean distance from the user's average features
+
+
+class Constraints:
+    '''Lower bounds, upper bounds and targets per feature, parsed from a target_features query string.
+
+    "min_energy=0.7&target_tempo=120" becomes low[energy] = 0.7 and target[tempo] = 120. Features
+    without a bound are unconstrained (-inf/+inf), features without a target are ignored (nan).
+    '''
+
+    def __init__(self, features, query):
+        self.features = tuple(features)
+        index = {name: i for i, name in enumerate(self.features)}
+        self.scale = np.array([FEATURE_SCALES.get(name, 1.0) for name in self.features], dtype=np.float32)
+        self.low = np.full(len(self.features), -np.inf, dtype=np.float32)
+        self.high = np.full(len(self.features), np.inf, dtype=np.float32)
+        self.target = np.full(len(self.features), np.nan, dtype=np.float32)
+        bounds = {'min': self.low, 'max': self.high, 'target': self.target}
+        for param in filter(None, query.split('&')):
+            key, _, value = param.partition('=')
+            kind, _, name = key.partition('_')
+            if kind in bounds and name in index:
+                bounds[kind][index[name]] = float(value)
+
+
+def score(matrix, constraints, user_features):
+    '''Higher is better, -inf for rows with missing features.'''
+    scaled = matrix / constraints.scale
+    violation = np.maximum(constraints.low / constraints.scale - scaled, 0) + np.maximum(scaled - constraints.high / constraints.scale, 0)
+    targeted = ~np.isnan(constraints.target)
+    target_gap = np.abs(scaled[:, targeted] - constraints.target[targeted] / constraints.scale[targeted])
+    affinity = np.abs(scaled - np.asarray(user_features, dtype=np.float32) / constraints.scale).mean(axis=1)
+    scores = -(VIOLATION_WEIGHT * violation.sum(axis=1) + TARGET_WEIGHT * target_gap.sum(axis=1) + AFFINITY_WEIGHT * affinity)
+    scores[np.isnan(scores)] = -np.inf
+    return scores
+
+def pick(scores, artist_codes, limit, per_artist_cap):
+    '''Indices of the best rows, at most per_artist_cap per artist code.'''
+    counts = [0] * (int(artist_codes.max()) + 1 if len(artist_codes) else 0)
+    codes = artist_codes.tolist()
+    picked = []
+    order = np.argsort(-scores, kind='stable')
+    for i, value in zip(order.tolist(), scores[order].tolist()):
+        if value == -np.inf or len(picked) == limit:
+            break
+        if counts[codes[i]] < per_artist_cap:
+            counts[codes[i]] += 1
+            picked.append(i)
+    return picked
+
+def rank(track_ids, artist_ids, vectors, constraints, user_features, limit, per_artist_cap):
+    '''Ranks candidates (parallel lists of track ID, artist ID and feature vector), returns track IDs.'''
+    if not track_ids:
+        return []
+    matrix = np.asarray(vectors, dtype=np.float32).reshape(len(track_ids), len(constraints.features))
+    _, artist_codes = np.unique(np.asarray(artist_ids), return_inverse=True)
+    return [track_ids[i] for i in pick(score(matrix, constraints, user_features), artist_codes, limit, per_artist_cap)]
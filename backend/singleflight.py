@@ -0,0 +1,96 @@
+import asyncio
+import threading
+from concurrent.futures import Future
+
+# Request coalescing: concurrent calls with the same key share one execution. The first caller
+# runs the call, callers arriving while it is in flight wait for it and get the same result. Only
+# successes are shared: a failure can come from the leader's own credentials (an expired session,
+# a 401), so when the leader fails each waiting caller makes the call itself. Nothing is kept once
+# the call finishes, caching stays the caches' job. Results are shared objects, so callers must
+# treat them as read-only.
+
+
+class Singleflight:
+    '''Coalesces concurrent calls with the same key across threads.'''
+
+    def __init__(self, name):
+        self.name = name
+        self._flights = {} # key -> Future of the call in flight
+        self._lock = threading.Lock()
+        self.calls = 0 # every do()
+        self.executions = 0 # calls actually made
+
+    def do(self, key, fn, *args):
+        with self._lock:
+            self.calls += 1
+            future = self._flights.get(key)
+            leader = future is None
+            if leader:
+                future = self._flights[key] = Future()
+                self.executions += 1
+        if not leader:
+            try:
+                return future.result()
+            except Exception: # the leader's failure, this caller makes the call with its own arguments
+                self._count_retry()
+                return fn(*args)
+        try:
+            result = fn(*args)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            self._forget(key, future)
+
+    def _count_retry(self):
+        with self._lock:
+            self.executions += 1
+
+    def _forget(self, key, flight):
+        with self._lock:
+            if self._flights.get(key) is flight:
+                del self._flights[key]
+
+    def stats(self):
+        with self._lock:
+            calls, executions, in_flight = self.calls, self.executions, len(self._flights)
+        return {
+            'calls': calls,
+            'executions': executions,
+            'coalesced': calls - executions,
+            'in_flight': in_flight,
+            'coalescing_ratio': round(calls / executions, 3) if executions else 0, # callers served per call made
+        }
+
+
+class AsyncSingleflight(Singleflight):
+    '''asyncio counterpart of Singleflight.
+
+    The call runs as its own task that every caller awaits through asyncio.shield, so a caller
+    being cancelled (a closed paginator, a client gone away) doesn't cancel it for the others.
+    '''
+
+    async def do(self, key, fn, *args):
+        with self._lock:
+            self.calls += 1
+            task = self._flights.get(key)
+            leader = task is None
+            if leader:
+                task = self._flights[key] = asyncio.ensure_future(fn(*args))
+                self.executions += 1
+                task.add_done_callback(lambda done: self._finish(key, done))
+        try:
+            return await asyncio.shield(task)
+        except Exception:
+            if leader:
+                raise
+            self._count_retry() # the leader's failure, this caller makes the call with its own arguments
+            return await fn(*args)
+
+    def _finish(self, key, task):
+        self._forget(key, task)
+        if not task.cancelled():
+            task.exception() # retrieved, so a failure nobody awaited anymore isn't reported as unhandled
@@ -0,0 +1,315 @@
+import bisect
+import contextvars
+import functools
+import hmac
+import inspect
+import json
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from urllib.parse import urlsplit
+
+# Request tracing, structured logs and Prometheus metrics.
+# Every request gets an ID, a route latency observation and one JSON log line. A sampled request
+# (TRACE_SAMPLE_RATE, or an `X-Trace` header carrying TRACE_SECRET) also records a span tree of the
+# traced helpers and outbound Spotify calls, logged with that line. Unsampled requests only pay a
+# context lookup per span.
+
+TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', 0))
+TRACE_SECRET = os.getenv('TRACE_SECRET') # unset, clients can't force a trace
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+# METRICS
+
+
+class Histogram:
+    '''Prometheus histogram with a fixed set of label names.'''
+
+    def __init__(self, name, help, labels, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self._series = {} # label values -> [bucket counts..., +Inf count, sum]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *label_values):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {labels: list(values) for labels, values in self._series.items()}
+        for label_values, values in sorted(series.items()):
+            labels = format_labels(zip(self.labels, label_values))
+            cumulative = 0
+            for bound, count in zip((*self.buckets, '+Inf'), values):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{format_labels(zip(self.labels, label_values), le=bound)} {cumulative}")
+            lines.append(f"{self.name}_sum{labels} {round(values[-1], 6)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Counter:
+    '''Prometheus counter with a fixed set of label names.'''
+
+    def __init__(self, name, help, labels):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = dict(self._values)
+        lines.extend(f"{self.name}{format_labels(zip(self.labels, labels))} {value}" for labels, value in sorted(values.items()))
+        return lines
+
+
+def format_labels(pairs, **extra):
+    items = [*pairs, *extra.items()]
+    if not items:
+        return ''
+    escape = lambda value: str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{name}="{escape(value)}"' for name, value in items) + '}'
+
+def render_gauges(name, help, samples):
+    '''Gauge lines for {labels tuple: stats dict}, one metric per numeric stat (name_<stat>).'''
+    metrics = {}
+    for labels, stats in samples.items():
+        for stat, value in stats.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                metrics.setdefault(stat, []).append((labels, value))
+    lines = []
+    for stat, values in sorted(metrics.items()):
+        metric = f"{name}_{stat}"
+        lines += [f"# HELP {metric} {help} ({stat})", f"# TYPE {metric} gauge"]
+        lines.extend(f"{metric}{format_labels(labels)} {value}" for labels, value in values)
+    return lines
+
+
+request_latency = Histogram('elevate_request_duration_seconds', 'Route latency.', ('route', 'method', 'status'))
+upstream_latency = Histogram('elevate_spotify_request_duration_seconds', 'Spotify call latency, retries included.', ('method', 'endpoint'))
+upstream_responses = Counter('elevate_spotify_responses_total', 'Spotify responses by final status.', ('method', 'endpoint', 'status'))
+upstream_retries = Counter('elevate_spotify_retries_total', 'Spotify attempts beyond the first (401 refreshes and 429 waits).', ('method', 'endpoint'))
+
+def render_metrics(extra_lines=()):
+    lines = []
+    for metric in (request_latency, upstream_latency, upstream_responses, upstream_retries):
+        lines += metric.render()
+    lines += extra_lines
+    return '\n'.join(lines) + '\n'
+
+ID_SEGMENT = re.compile(r'(playlists|users|artists|albums|tracks)/[^/]+')
+
+def endpoint_label(url, base_url): # low-cardinality name for a Spotify URL, e.g. playlists/{id}/tracks
+    path = url[len(base_url):] if url.startswith(base_url) else urlsplit(url).path
+    return ID_SEGMENT.sub(r'\1/{id}', path.split('?', 1)[0].strip('/'))
+
+
+# TRACING
+
+
+class Span:
+    __slots__ = ('name', 'attrs', 'start', 'duration', 'children')
+
+    def __init__(self, name, attrs=None):
+        self.name = name
+        self.attrs = attrs or {}
+        self.start = time.perf_counter()
+        self.duration = None
+        self.children = []
+
+    def end(self):
+        self.duration = time.perf_counter() - self.start
+
+    def to_dict(self, origin=None):
+        origin = self.start if origin is None else origin
+        entry = {
+            'name': self.name,
+            'start_ms': round((self.start - origin) * 1000, 2),
+            'ms': round(self.duration * 1000, 2) if self.duration is not None else None,
+        }
+        if self.attrs:
+            entry['attrs'] = self.attrs
+        if self.children:
+            entry['children'] = [child.to_dict(origin) for child in list(self.children)]
+        return entry
+
+
+class RequestScope:
+    '''One request's ID, outbound call count and, when sampled, its root span.'''
+
+    __slots__ = ('request_id', 'route', 'method', 'root', 'calls', 'start', '_tokens')
+
+    def __init__(self, request_id, route, method, sampled):
+        self.request_id = request_id
+        self.route = route
+        self.method = method
+        self.root = Span(f"{method} {route}") if sampled else None
+        self.calls = 0
+        self.start = time.perf_counter()
+
+
+current_scope = contextvars.ContextVar('current_scope', default=None)
+current_span = contextvars.ContextVar('current_span', default=None) # None unless the request is sampled
+
+def trace_requested(header): # an X-Trace value forces a trace only when it's the shared TRACE_SECRET
+    return bool(TRACE_SECRET and header) and hmac.compare_digest(header.encode(), TRACE_SECRET.encode())
+
+def begin_request(route, method, request_id=None, force_trace=False):
+    scope = RequestScope(request_id or uuid.uuid4().hex[:16], route, method, force_trace or random.random() < TRACE_SAMPLE_RATE)
+    scope._tokens = (current_scope.set(scope), current_span.set(scope.root))
+    return scope
+
+def end_request(scope, status, error=None):
+    elapsed = time.perf_counter() - scope.start
+    request_latency.observe(elapsed, scope.route, scope.method, str(status))
+    fields = {'route': scope.route, 'method': scope.method, 'status': status, 'ms': round(elapsed * 1000, 2), 'spotify_calls': scope.calls}
+    if error:
+        fields['error'] = error
+    if scope.root is not None:
+        scope.root.end()
+        fields['trace'] = scope.root.to_dict()
+    log_event('request', level=logging.ERROR if status >= 500 else logging.INFO, **fields)
+    scope_token, span_token = scope._tokens
+    try:
+        current_span.reset(span_token)
+        current_scope.reset(scope_token)
+    except ValueError: # ended by a streamed body running in a copy of the request's context
+        current_span.set(None)
+        current_scope.set(None)
+
+class SpanContext:
+    '''Times a block as a child of the current span, a no-op when the request isn't sampled.'''
+
+    __slots__ = ('name', 'attrs', '_span', '_token')
+
+    def __init__(self, name, attrs):
+        self.name = name
+        self.attrs = attrs
+        self._span = None
+
+    def __enter__(self):
+        parent = current_span.get()
+        if parent is not None:
+            self._span = Span(self.name, self.attrs)
+            parent.children.append(self._span)
+            self._token = current_span.set(self._span)
+        return self._span
+
+    def __exit__(self, exc_type, exc, tb):
+        if self._span is not None:
+            self._span.end()
+            if exc is not None:
+                self._span.attrs['error'] = str(exc)
+            current_span.reset(self._token)
+
+def span(name, **attrs):
+    return SpanContext(name, attrs)
+
+def traced(fn):
+    '''Decorator recording each call of a helper (plain or async) as a span.'''
+    if inspect.iscoroutinefunction(fn):
+        @functools.wraps(fn)
+        async def async_wrapper(*args, **kwargs):
+            if current_span.get() is None:
+                return await fn(*args, **kwargs)
+            with span(fn.__name__):
+                return await fn(*args, **kwargs)
+        return async_wrapper
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if current_span.get() is None:
+            return fn(*args, **kwargs)
+        with span(fn.__name__):
+            return fn(*args, **kwargs)
+    return wrapper
+
+class OutboundCall:
+    '''Records one logical Spotify call: latency histogram always, a span when sampled.
+
+    The client sets `attempts`, `status` and `bytes` on the returned object as it goes.
+    '''
+
+    __slots__ = ('method', 'endpoint', 'attempts', 'status', 'bytes', 'start')
+
+    def __init__(self, method, endpoint):
+        self.method = method
+        self.endpoint = endpoint
+        self.attempts = 0
+        self.status = None
+        self.bytes = 0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        elapsed = time.perf_counter() - self.start
+        status = str(self.status) if exc is None else 'error'
+        upstream_latency.observe(elapsed, self.method, self.endpoint)
+        upstream_responses.inc(self.method, self.endpoint, status)
+        if self.attempts > 1:
+            upstream_retries.inc(self.method, self.endpoint, amount=self.attempts - 1)
+        scope = current_scope.get()
+        if scope is not None:
+            scope.calls += 1
+        parent = current_span.get()
+        if parent is not None:
+            child = Span(f"spotify {self.method} {self.endpoint}", {'status': status, 'bytes': self.bytes, 'retries': max(self.attempts - 1, 0)})
+            child.start = self.start
+            child.duration = elapsed
+            parent.children.append(child)
+
+
+# LOGGING
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname.lower(),
+            'event': record.getMessage(),
+        }
+        scope = current_scope.get()
+        if scope is not None:
+            entry['request_id'] = scope.request_id
+        entry.update(getattr(record, 'fields', {}))
+        return json.dumps(entry, default=str)
+
+logger = logging.getLogger('elevate')
+if not logger.handlers:
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(JsonFormatter())
+    logger.addHandler(handler)
+    logger.setLevel(os.getenv('LOG_LEVEL', 'INFO').upper())
+    logger.propagate = False
+
+def log_event(event, level=logging.INFO, **fields):
+    if logger.isEnabledFor(level):
+        logger.log(level, event, extra={'fields': fields})
+
+def log_error(message, **fields):
+    log_event('error', level=logging.ERROR, message=message, **fields)
@@ -3,6 +3,18 @@ import { useNavigate } from 'react-router-dom';
 import { FontAwesomeIcon } from '@fortawesome/react-fontawesome';
 import { faArrowUpRightFromSquare, faX, faPlay, faPause } from '@fortawesome/free-solid-svg-icons';
 
+// The backend's signed session ID. Login hands it over in the redirect's #session= fragment, and it's
+// sent back as X-Session because the session cookie doesn't reach the API hosts cross-site.
+const sessionHeaders = () => {
+  const match = window.location.hash.match(/session=([^&]+)/);
+  if (match) {
+    localStorage.setItem('elevateSession', decodeURIComponent(match[1]));
+    window.history.replaceState(null, '', window.location.pathname);
+  }
+  const token = localStorage.getItem('elevateSession');
+  return token ? { 'X-Session': token } : {};
+};
+
 function Profile() {
   const [username, setUsername] = useState('');
   const navigate = useNavigate();
@@ -21,6 +33,7 @@ function Profile() {
       try {
         const response = await fetch('https://zmypmq3suh.execute-api.us-east-2.amazonaws.com/profile', {
           method: 'GET',
+          headers: sessionHeaders(),
           credentials: 'include'
         });
 
@@ -77,10 +90,12 @@ function Profile() {
     stopCurrentAudio()
     fetch('https://tg2u62c04h.execute-api.us-east-2.amazonaws.com/logout', {
       method: 'GET',
+      headers: sessionHeaders(),
       credentials: 'include',
     })
       .then(response => {
         if (response.ok) {
+          localStorage.removeItem('elevateSession');
           window.location.href = 'https://main.d30okcwstuwyij.amplifyapp.com';
         } else {
           return response.json().then(errorData => {
@@ -117,8 +132,9 @@ function Profile() {
       method: 'POST',
       headers: {
         'Content-Type': 'application/json',
+        ...sessionHeaders(),
       },
-      body: JSON.stringify({ ...formData }),
+      body: JSON.stringify({ ...formData, fields: 'compact' }), // only the track fields rendered below
       credentials: 'include',
     })
       .then(response => {
@@ -181,7 +197,8 @@ function Profile() {
     fetch('http://18.218.68.142:5001/build', {
       method: 'POST',
       headers: {
-        'Content-Type': 'application/json'
+        'Content-Type': 'application/json',
+        ...sessionHeaders(),
       },
       body: JSON.stringify({ name: nameData.playlistName, songs: myPlaylist }),
       credentials: 'include'